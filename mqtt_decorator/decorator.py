@@ -2,7 +2,7 @@ from paho.mqtt import client as mqtt
 from functools import wraps, partial
 import json
 import yaml
-from typing import MutableMapping, Pattern, Union, Callable, Any, Iterable, Match, Mapping, Tuple
+from typing import MutableMapping, Pattern, Union, Callable, Any, Iterable, Match, Mapping, Tuple, Dict, List
 import inspect
 from logging import getLogger
 import re
@@ -26,28 +26,70 @@ class Callback:
 
 _key_type = Union[Pattern, str]
 
+SINGLE_LEVEL = '+'
+MULTI_LEVEL = '#'
+
+
+def is_wildcard(topic: str) -> bool:
+    return SINGLE_LEVEL in topic or MULTI_LEVEL in topic
+
+
+class _TopicNode:
+    """
+    One level of the wildcard-topic trie. Children are keyed by the level name, single-level wildcard is stored as
+    an ordinary child with '+' key, filters ending with '#' are kept in multi
+    """
+    __slots__ = ('children', 'callbacks', 'multi')
+
+    def __init__(self):
+        self.children: Dict[str, '_TopicNode'] = {}
+        self.callbacks: Dict[str, Callback] = {}
+        self.multi: Dict[str, Callback] = {}
+
 
 class Subscriptions(MutableMapping[_key_type, Tuple[Callback, Union[str, dict, Match]]]):
+    """
+    Topic -> Callback mapping. Keys can be:
+
+        - exact topics, stored in a plain dict
+        - MQTT filters with '+' and '#' wildcards, stored in a topic-level trie
+        - compiled regex patterns, checked one by one only as a fallback
+
+    Use match to get all the callbacks for the incoming topic in one pass, item access returns the first one
+    """
 
     def __init__(self):
         self._container = dict()
+        self._exact: Dict[str, Callback] = {}
+        self._root = _TopicNode()
+        self._patterns: Dict[Pattern, Callback] = {}
 
     def __setitem__(self, key: _key_type, value: Callback):
+        if key in self._container:
+            del self[key]
         self._container[key] = value
+        if isinstance(key, str):
+            if is_wildcard(key):
+                self._trie_add(key, value)
+            else:
+                self._exact[key] = value
+        else:
+            self._patterns[key] = value
 
     def __getitem__(self, item):
-        for _k, _c in self._container.items():
-            if isinstance(_k, str) and _k == item:
-                return _c, item
-            elif isinstance(_k, Pattern) and _k.search(item):
-                if _c.parse_topic:
-                    return _c, _k.search(item).groupdict()
-                else:
-                    return _c, _k.search(item)
+        for ret in self.match(item):
+            return ret
         raise KeyError(item)
 
     def __delitem__(self, key):
         self._container.__delitem__(key)
+        if isinstance(key, str):
+            if is_wildcard(key):
+                self._trie_remove(key)
+            else:
+                del self._exact[key]
+        else:
+            del self._patterns[key]
 
     def __iter__(self):
         return self._container.__iter__()
@@ -55,6 +97,79 @@ class Subscriptions(MutableMapping[_key_type, Tuple[Callback, Union[str, dict, M
     def __len__(self):
         return self._container.__len__()
 
+    def match(self, topic: str) -> List[Tuple[Callback, Union[str, dict, Match]]]:
+        """
+        Collect all callbacks subscribed to topic: exact one first, then wildcard filters, then regex patterns
+        :param topic:
+        :return: list of (callback, parsed topic) pairs
+        """
+        ret = []
+        _c = self._exact.get(topic)
+        if _c is not None:
+            ret.append((_c, topic))
+        if self._root.children:
+            ret.extend((_c, topic) for _c in self._trie_match(topic))
+        for _k, _c in self._patterns.items():
+            found = _k.search(topic)
+            if found:
+                ret.append((_c, found.groupdict() if _c.parse_topic else found))
+        return ret
+
+    def _trie_add(self, key: str, value: Callback):
+        node = self._root
+        levels = key.split('/')
+        for i, level in enumerate(levels):
+            if level == MULTI_LEVEL:
+                if i != len(levels) - 1:
+                    raise ValueError(f'"{MULTI_LEVEL}" must be the last level of the topic filter: {key}')
+                node.multi[key] = value
+                return
+            node = node.children.setdefault(level, _TopicNode())
+        node.callbacks[key] = value
+
+    def _trie_remove(self, key: str):
+        path = [self._root]
+        levels = key.split('/')
+        for level in levels:
+            if level == MULTI_LEVEL:
+                break
+            path.append(path[-1].children[level])
+        if levels[-1] == MULTI_LEVEL:
+            del path[-1].multi[key]
+        else:
+            del path[-1].callbacks[key]
+        # prune empty branches
+        for parent, node, level in zip(reversed(path[:-1]), reversed(path[1:]), reversed(levels[:len(path) - 1])):
+            if node.children or node.callbacks or node.multi:
+                break
+            del parent.children[level]
+
+    def _trie_match(self, topic: str) -> Iterable[Callback]:
+        levels = topic.split('/')
+        # wildcards on the first level must not match system topics
+        system = topic.startswith('$')
+        nodes = [self._root]
+        for i, level in enumerate(levels):
+            if not nodes:
+                return
+            wild = not (system and i == 0)
+            _next = []
+            for node in nodes:
+                if wild:
+                    yield from node.multi.values()
+                child = node.children.get(level)
+                if child is not None:
+                    _next.append(child)
+                if wild:
+                    child = node.children.get(SINGLE_LEVEL)
+                    if child is not None:
+                        _next.append(child)
+            nodes = _next
+        for node in nodes:
+            yield from node.callbacks.values()
+            # "a/#" also matches "a"
+            yield from node.multi.values()
+
 
 def regexp_parser(patt: Pattern):
     def parse(txt):
@@ -96,12 +211,17 @@ class Client(mqtt.Client):
 
     def cb_wrap(self, client, userdata, msg):
         logger.debug(f'msg arrived {msg}')
-        cb, topic = self._subscriptions[msg.topic]
-        if cb.parse_payload:
-            data: dict = json.loads(msg.payload)
-        else:
-            data = msg.payload
-        return cb(topic, data)
+        callbacks = self._subscriptions.match(msg.topic)
+        if not callbacks:
+            raise KeyError(msg.topic)
+        ret = None
+        for cb, topic in callbacks:
+            if cb.parse_payload:
+                data: dict = json.loads(msg.payload)
+            else:
+                data = msg.payload
+            ret = cb(topic, data)
+        return ret
 
     def subscribe_handler(self
                           , topic
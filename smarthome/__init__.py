@@ -5,5 +5,9 @@ from .rules import rule
 from . import core
 from . import const
 from . import things
-from . import bindings
-from .app import App
+
+# imported on first use, see bindings and utils for lazy loading of binding's dependencies
+utils.lazy_module(globals(), {
+    'bindings': ('.bindings', None),
+    'App': ('.app', 'App'),
+})
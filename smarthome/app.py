@@ -1,19 +1,40 @@
 from concurrent.futures.thread import ThreadPoolExecutor
 import asyncio
+import time
 
-from .thing import Thing
+from collections import defaultdict
+
+from .thing import Thing, Group
 from .bindings.binding import Binding
 import typing
 from .const import logger, Logger
 import types
 import typing
 from asyncio_primitives import utils as autils
+from .utils.scheduler import scheduler, Scheduler
+from .store import StateStore
+from .metrics import registry as metrics
 
 logger = logger.getChild('app')
 
+# how many bindings can be started at the same time
+DEF_START_CONCURRENCY = 10
+# seconds to wait for binding to start
+DEF_BINDING_TIMEOUT = 60
+
+# bases of Thing, that are not indexed by type
+_THING_BASES = frozenset(Thing.__mro__[1:])
+
+
 class App(object):
 
     name: str = 'app'
+    start_concurrency: int = DEF_START_CONCURRENCY
+    binding_timeout: float = DEF_BINDING_TIMEOUT
+    # if set, values of states are restored from it on start and saved to it on change
+    store: StateStore = None
+    # if set, metrics are collected and served in Prometheus text format at http://127.0.0.1:{metrics_port}/metrics
+    metrics_port: int = None
 
     def __init__(self):
         from . import Thing
@@ -21,13 +42,32 @@ class App(object):
         self.threadPool = ThreadPoolExecutor()
         self._loop = asyncio.get_event_loop()
         self.started = asyncio.Event()
+        # all the time-based rules are dispatched by one scheduler
+        self.scheduler: Scheduler = scheduler
         for n, x in self.__class__.__dict__.items():
             if isinstance(x, (Thing, Binding)):
                 x._app = self
-        self._things: typing.List[Thing] = [getattr(self, x) for x, v in self.__class__.__dict__.items() if isinstance(v, Thing)]
+        self._things: typing.List[Thing] = []
+        # indexes of things
+        self._by_id: typing.Dict[str, Thing] = {}
+        self._by_root: typing.DefaultDict[str, typing.List[Thing]] = defaultdict(list)
+        self._by_type: typing.DefaultDict[type, typing.List[Thing]] = defaultdict(list)
+        # dicts are used as ordered sets
+        self._by_binding: typing.DefaultDict[Binding, typing.Dict[Thing, None]] = defaultdict(dict)
+        self.groups: typing.Dict[str, Group] = {}
+        for x, v in self.__class__.__dict__.items():
+            if isinstance(v, Thing):
+                self.add_thing(getattr(self, x))
         self._bindings: typing.List[Binding] = [getattr(self, x) for x, v in self.__class__.__dict__.items() if isinstance(v, Binding)]
         self._task_starters = []
         self._tasks = []
+        # component -> seconds it took to start
+        self.startup_timings: typing.Dict[str, float] = {}
+        # component -> why it did not start: bindings that failed or timed out, things skipped because of them
+        self.startup_errors: typing.Dict[str, Exception] = {}
+        self._metrics_server: asyncio.AbstractServer = None
+        # metrics.enabled before start, it is restored on stop
+        self._metrics_enabled: bool = None
 
     @property
     def loop(self) -> asyncio.AbstractEventLoop:
@@ -36,6 +76,46 @@ class App(object):
     def get_things(self) -> typing.List[Thing]:
         return self._things
 
+    def add_thing(self, thing: Thing):
+        """
+        Add thing to the app and its indexes, thing must already have its name
+        :param thing:
+        :return:
+        """
+        self._things.append(thing)
+        self._by_id[thing.unique_id] = thing
+        self._by_root[thing.root].append(thing)
+        # every class of the thing is indexed, mixins included, except bases of Thing itself
+        for cls in thing.__class__.__mro__:
+            if cls not in _THING_BASES:
+                self._by_type[cls].append(thing)
+        for x in thing.bound_to:
+            self.on_bind(thing, x)
+
+    def on_bind(self, thing: Thing, binding: Binding):
+        """
+        Called by Thing.bind_to to keep binding index up to date
+        """
+        self._by_binding[binding][thing] = None
+
+    def get_thing(self, unique_id: str) -> typing.Optional[Thing]:
+        return self._by_id.get(unique_id)
+
+    def things_by_type(self, cls: typing.Type[Thing]) -> typing.List[Thing]:
+        """
+        Things, that are instances of cls (subclasses are included), list is a copy of the index
+        """
+        return list(self._by_type.get(cls, ()))
+
+    def things_by_root(self, root: str) -> typing.List[Thing]:
+        return list(self._by_root.get(root, ()))
+
+    def things_by_binding(self, binding: Binding) -> typing.List[Thing]:
+        """
+        Things, bound to binding, index is filled when bind_to callbacks are run on app start
+        """
+        return list(self._by_binding.get(binding, ()))
+
     def get_bindings(self) -> typing.List[Binding]:
         return typing.cast(
             typing.List[Binding]
@@ -43,7 +123,28 @@ class App(object):
         )
 
     async def start(self):
+        """
+        Start the app:
+
+            - things run their start callbacks (eg bind_to), so that bindings know their subscriptions, failure
+              of one thing is logged and does not stop the others
+            - if app has store, states are restored from it and attached to it
+            - if app has metrics_port, metrics are enabled and served on it, till the app is stopped
+            - bindings are started concurrently, at most start_concurrency at a time, each one is limited with
+              binding.start_timeout or app.binding_timeout
+            - every thing starts its rules as soon as bindings it is bound to are started (or failed), thing which
+              bindings all failed is skipped, so that its rules do not push to dead bindings
+            - if app has bindings and none of them started, RuntimeError is raised
+            - rules defined in conf modules are started
+
+        Time spent by every component is saved in startup_timings, bindings that did not start and things skipped
+        because of them are saved in startup_errors
+        :return:
+        """
         lck = asyncio.Lock()
+        started = time.perf_counter()
+        sem = asyncio.Semaphore(self.start_concurrency)
+        failed: typing.Set[Binding] = set()
 
         async def start_starter(name, starter):
             task = await starter()
@@ -51,18 +152,78 @@ class App(object):
             async with lck:
                 self._tasks.append(task)
 
+        async def timed(name, coro):
+            _started = time.perf_counter()
+            try:
+                return await coro
+            finally:
+                self.startup_timings[name] = time.perf_counter() - _started
+
+        async def start_binding(binding: Binding):
+            # bindings from different modules can share the name, id keeps their timings apart
+            name = f'binding {getattr(binding, "name", binding.__class__.__name__)}@{id(binding):x}'
+            timeout = binding.start_timeout or self.binding_timeout
+            async with sem:
+                try:
+                    if await timed(name, asyncio.wait_for(binding._start(), timeout)) is True:
+                        return
+                    error = RuntimeError(f'{name} did not start')
+                    logger.error(str(error))
+                except asyncio.TimeoutError:
+                    error = asyncio.TimeoutError(f'{name} did not start in {timeout} seconds')
+                    logger.error(str(error))
+                except Exception as err:
+                    error = err
+                    logger.exception(f'{name} failed to start: {err}')
+                self.startup_errors[name] = error
+                failed.add(binding)
+
+        async def start_thing(thing: Thing):
+            bindings = [binding_tasks[x] for x in thing.bound_to if x in binding_tasks]
+            if bindings:
+                await asyncio.wait(bindings)
+            dead = [x for x in thing.bound_to if x in failed]
+            if dead and len(dead) == len(thing.bound_to):
+                err = RuntimeError(f'{thing.unique_id} is not started, none of its bindings started')
+                logger.error(str(err))
+                self.startup_errors[f'thing {thing.unique_id}'] = err
+                return
+            if dead:
+                logger.warning(f'{thing.unique_id} is started, but {", ".join(str(x.name) for x in dead)} did not')
+            await timed(f'thing {thing.unique_id}', thing.start_rules())
+
         for x in self.get_things():
             x._app = self
-            await x.start()
+            # misconfigured thing (eg wrong bind_to arguments) must not stop the rest of the app
+            try:
+                await x.prepare()
+            except Exception as err:
+                logger.exception(f'{x.unique_id} failed to prepare: {err}')
+
+        if self.store is not None:
+            await timed('store', self.store.restore(self.get_things()))
+            self.store.attach(*self.get_things())
+            self._tasks.append(await self.store.start())
+
+        if self.metrics_port is not None:
+            self._metrics_enabled = metrics.enabled
+            metrics.enabled = True
+            self._metrics_server = await metrics.serve(port=self.metrics_port)
 
         for x in self.get_bindings():
             x._app = self
-            await x._start()
+        binding_tasks = {x: asyncio.ensure_future(start_binding(x)) for x in self.get_bindings()}
+        await asyncio.gather(*binding_tasks.values(), *[start_thing(x) for x in self.get_things()])
+        if binding_tasks and len(failed) == len(binding_tasks):
+            raise RuntimeError(f'{self} did not start, none of bindings started: {", ".join(self.startup_errors)}')
 
         if self._task_starters:
-            await asyncio.gather(*[start_starter(n, x) for n, x in self._task_starters])
+            await asyncio.gather(*[timed(f'rule {n}', start_starter(n, x)) for n, x in self._task_starters])
 
-        logger.info(f'{self} started!')
+        self.startup_timings['total'] = time.perf_counter() - started
+        for name, took in sorted(self.startup_timings.items(), key=lambda x: -x[1]):
+            logger.debug(f'{name} started in {took:.3f}s')
+        logger.info(f'{self} started in {self.startup_timings["total"]:.3f}s!')
 
     async def stop(self):
         from .utils.utils import cancel_tasks
@@ -75,6 +236,15 @@ class App(object):
 
         await cancel_tasks(*self._tasks)
 
+        if self.store is not None:
+            await self.store.close()
+
+        if self._metrics_server is not None:
+            self._metrics_server.close()
+            await self._metrics_server.wait_closed()
+            self._metrics_server = None
+            metrics.enabled = self._metrics_enabled
+
         logger.debug(f'{self.name} stopped')
 
     @classmethod
@@ -85,16 +255,19 @@ class App(object):
         lck = asyncio.Lock()
         for roots, name, val in item_load(mod):
             _name = '.'.join(roots[1:] + [name])
-            if isinstance(val, (Thing, Binding)):
+            if isinstance(val, Thing):
+                val._app = new_app
+                val.name = _name
+                new_app.add_thing(val)
+            elif isinstance(val, Binding):
                 val._app = new_app
                 val.name = _name
-                if isinstance(val, Thing):
-                    new_app._things.append(val)
-                if isinstance(val, Binding):
-                    new_app._bindings.append(val)
-            if isinstance(val, asyncio.Task):
+                new_app._bindings.append(val)
+            elif isinstance(val, Group):
+                new_app.groups[_name] = val
+            elif isinstance(val, asyncio.Task):
                 new_app._tasks.append(val)
-            elif autils.is_starter(val):
+            else:
                 new_app._task_starters.append((name, val))
 
         return new_app
@@ -107,9 +280,7 @@ def item_load(mod: types.ModuleType, roots: list = None):
         roots = roots + [mod.__name__]
 
     for name, val in mod.__dict__.items():
-        from . import Thing
-        from .bindings.binding import Binding
-        if isinstance(val, (Thing, Binding, asyncio.Task)):
+        if isinstance(val, (Thing, Binding, Group, asyncio.Task)):
             yield roots, name, val
         elif getattr(val, '__isconf__', False):
             yield from item_load(val, roots)
@@ -1,4 +1,10 @@
 from .binding import Binding
-from .async_mqtt import MqttBinding
-from .megad import MegaBinding
-from megad.const import InputQuery as MegaInput
\ No newline at end of file
+from ..utils.lazy import lazy_module
+
+# bindings are imported on first use, so that their third-party dependencies (hbmqtt, megad) are loaded only when
+# they are really needed
+lazy_module(globals(), {
+    'MqttBinding': ('.async_mqtt', 'MqttBinding'),
+    'MegaBinding': ('.megad', 'MegaBinding'),
+    'MegaInput': ('megad.const', 'InputQuery'),
+})
@@ -1,17 +1,23 @@
 from .binding import Binding, logger, Logger
 from ..state import State
-from typing import TypeVar, Pattern, Callable
+from typing import TypeVar, Pattern, Callable, Dict, Optional, Tuple
 from hbmqtt.client import MQTTClient
 from hbmqtt.mqtt import constants as mqtt_const
 from hbmqtt.session import ApplicationMessage
 from logging import getLogger
 import warnings
+import typing
 import attr
 
 import re
+import time
+import zlib
 import asyncio
+from collections import OrderedDict
 from dataclasses import dataclass
 from asyncio_primitives import utils as autils
+from ..utils.workers import WorkerPool, BLOCK, DEF_WORKERS, DEF_BACKLOG
+from ..metrics import registry as metrics, BINDING_PUSHES, MQTT_RECEIVED, MQTT_HANDLE_SECONDS, MQTT_OUT_QUEUE
 
 logger: Logger = logger.getChild('mqtt')
 
@@ -26,11 +32,99 @@ DEF_IN_TOPIC = '/{app_name}/{thing_id}/{state_name}/in'
 SUBS_IN_TOPIC = '/{app_name}/+/+/in'
 DEF_SUBSCRIBE_TOPIC = '/{app_name}/+/+/in'
 
+# max number of topics, resolved at runtime with parse_topic, that are kept in routing cache
+DEF_ROUTE_CACHE_SIZE = 4096
+
+# seconds to collect pushed changes before publishing them
+DEF_FLUSH_WINDOW = 0
+# max number of messages published in one batch
+DEF_MAX_BATCH = 100
+# max number of publishes awaited concurrently
+DEF_MAX_IN_FLIGHT = 10
+# seconds before failed publishes are retried, delay is doubled after every failed retry up to DEF_MAX_RETRY_DELAY
+DEF_RETRY_DELAY = 1
+DEF_MAX_RETRY_DELAY = 60
+
 _cnt = 0
 
+
+class MqttShard(object):
+    """
+    One client connection of MqttBinding. It subscribes to topics of its part of things and delivers messages in its
+    own loop. Messages are handled by a pool of workers: messages of one thing are handled in order, slow rules of one
+    thing do not block the others
+    """
+
+    def __init__(self, binding: 'MqttBinding', index: int, uri: str, client_id: str
+                 , workers: int = DEF_WORKERS
+                 , backlog: int = DEF_BACKLOG
+                 , overflow: str = BLOCK):
+        self.binding = binding
+        self.index = index
+        self.uri = uri
+        self.client = MQTTClient(client_id=client_id)
+        self.topics: typing.List[str] = []
+        self.pool = WorkerPool(self.handle, workers=workers, backlog=backlog, overflow=overflow, name=str(index))
+        # counters
+        self.received = 0
+        self.unrouted = 0
+
+    def __str__(self):
+        return f'{self.binding}[{self.index}]'
+
+    @property
+    def stats(self) -> dict:
+        ret = self.pool.stats
+        ret.update(received=self.received, unrouted=self.unrouted)
+        return ret
+
+    async def start(self) -> typing.List[asyncio.Task]:
+        """
+        Connect, subscribe to topics and start delivery loop and workers
+        :return: tasks of delivery loop and workers
+        """
+        await self.client.connect(self.uri)
+        if self.topics:
+            await self.client.subscribe([(x, mqtt_const.QOS_0) for x in self.topics])
+        logger.debug(f'{self} connected to {self.uri} and subscribed to {len(self.topics)} topics')
+        return await self.pool.start() + [await self._loop()]
+
+    @autils.endless_loop
+    @autils.set_logger(logger)
+    async def _loop(self):
+        msg = await self.client.deliver_message()
+        self.received += 1
+        state = self.binding.route(msg.topic)
+        if state is None:
+            self.unrouted += 1
+            warnings.warn(f'{msg.topic} is not found or not binded to {self.binding.name}')
+            return
+        await self.pool.put(state.thing.unique_id, (state, msg), coalesce=msg.topic)
+
+    async def handle(self, item: Tuple[State, ApplicationMessage]):
+        state, msg = item
+        logger.debug(f'{self} handle {msg.topic}: {msg.data}')
+        await self.binding._handle_routed(state, msg)
+
+    async def stop(self):
+        if self.topics:
+            await self.client.unsubscribe(self.topics)
+        try:
+            while True:
+                task: asyncio.Future = self.client.client_tasks.pop()
+                task.cancel()
+        except IndexError as err:
+            pass
+        await self.client.disconnect()
+
+
 class MqttBinding(Binding):
     """
     MQTT Client runs in a separate thread, pushes recieved data to the main thread that processes it in async-fashion
+
+    In sharded mode (shards > 1) binding opens several connections, to one broker or to every of hosts in turn.
+    Things are partitioned between shards by hash of thing_id: every shard subscribes to incoming topics of its things,
+    publishes their outgoing messages and delivers messages in its own loop
     """
     eho_safe = True
 
@@ -42,18 +136,76 @@ class MqttBinding(Binding):
                  , out_topic: str = DEF_OUT_TOPIC
                  , data_handler: Callable = None
                  , auth: str = None  #"usr:pass"
+                 , route_cache_size: int = DEF_ROUTE_CACHE_SIZE
+                 , flush_window: float = DEF_FLUSH_WINDOW
+                 , max_batch: int = DEF_MAX_BATCH
+                 , max_in_flight: int = DEF_MAX_IN_FLIGHT
+                 , retry_delay: float = DEF_RETRY_DELAY
+                 , shards: int = 1
+                 , hosts: typing.List[str] = None
+                 , workers: int = DEF_WORKERS
+                 , backlog: int = DEF_BACKLOG
+                 , overflow: str = BLOCK
+                 , client_id: str = 'mqtt_binding'
                  ):
-        self.mqtt = MQTTClient(client_id='mqtt_binding')
+        """
+        :param retry_delay: seconds before messages, that failed to publish, are published again without waiting for
+            the next push, delay is doubled after every failed retry
+        :param shards: number of client connections
+        :param hosts: brokers of shards as "host[:port]", shards are spread between them, by default host:port is used
+        :param workers: number of workers handling messages in every shard, messages of one thing are handled by
+            the same worker in order
+        :param backlog: max number of pending messages per worker
+        :param overflow: what to do with a message when backlog is full: block delivery (BLOCK), drop the oldest
+            message (DROP_OLDEST) or replace pending message with the same topic (COALESCE), see utils.workers
+        :param client_id: client id, shards add their index to it
+        """
+        assert shards >= 1, 'shards must be positive'
         self.root_topic = subscribe_topic
         self.host=host
         self.port= f':{port}' if port else ''
+        self.auth = auth or ''
+        hosts = hosts or [f'{self.host}{self.port}']
+        self.shards: typing.List[MqttShard] = [
+            MqttShard(
+                self
+                , index=i
+                , uri=self._make_uri(hosts[i % len(hosts)])
+                , client_id=client_id if shards == 1 else f'{client_id}-{i}'
+                , workers=workers
+                , backlog=backlog
+                , overflow=overflow
+            ) for i in range(shards)
+        ]
+        self.mqtt = self.shards[0].client
         self.in_topic = in_topic
         self.out_topic = out_topic
         self.data_handler = data_handler
         self.data_lock = asyncio.Lock()
-        self.auth = auth or ''
         self.loop_to_stop: asyncio.Future = None
         self._parse_topic: Pattern = None
+        # topics that are not in addresses, resolved with parse_topic, least recently used are dropped first
+        self._route_cache: typing.OrderedDict[str, Optional[State]] = OrderedDict()
+        self.route_cache_size = route_cache_size
+        # outbound queue: (thing_id, state_name) -> (state, payload), if state is pushed again before flush,
+        # only the last payload is published
+        self._out_queue: typing.OrderedDict[Tuple[str, str], Tuple[State, bytes]] = OrderedDict()
+        self._out_ready = asyncio.Event()
+        self._out_topics: Dict[Tuple[str, str], str] = {}
+        self.flush_window = flush_window
+        self.max_batch = max_batch
+        self.max_in_flight = max_in_flight
+        self.retry_delay = retry_delay
+        # delay of the next retry, 0 after successful flush
+        self._next_retry_delay = 0
+        self._retry: asyncio.TimerHandle = None
+        # counters
+        self.published = 0
+        self.publish_errors = 0
+        self.batches = 0
+        self.flush_latency = 0.0
+        self.max_flush_latency = 0.0
+        self._flush_latency_total = 0.0
         super().__init__()
 
     @property
@@ -62,9 +214,9 @@ class MqttBinding(Binding):
             self._parse_topic = re.compile(
                 self.in_topic.format(
                     app_name = self.app.name
-                    , thing_id = rf'(?P<{THING_ID}>.*)'
-                    , state_name = rf'(?P<{STATE_NAME}>.*)'
-                ), re.IGNORECASE)
+                    , thing_id = rf'(?P<{THING_ID}>[^/]+)'
+                    , state_name = rf'(?P<{STATE_NAME}>[^/]+)'
+                ) + '$', re.IGNORECASE)
         return self._parse_topic
 
     @property
@@ -77,57 +229,220 @@ class MqttBinding(Binding):
             app_name=self.app.name
         )
 
-    @property
-    def uri(self):
+    def _make_uri(self, host: str):
         if self.auth:
-            return f'mqtt://{self.auth}@{self.host}{self.port}'
+            return f'mqtt://{self.auth}@{host}'
         else:
-            return f'mqtt://{self.host}{self.port}'
+            return f'mqtt://{host}'
+
+    @property
+    def uri(self):
+        return self._make_uri(f'{self.host}{self.port}')
+
+    def shard_of(self, thing_id: str) -> MqttShard:
+        if len(self.shards) == 1:
+            return self.shards[0]
+        return self.shards[zlib.crc32(thing_id.encode()) % len(self.shards)]
+
+    @property
+    def stats(self) -> dict:
+        """
+        Counters summed over all the shards (latencies are the worst of shards), per-shard stats are under "shards" key
+        """
+        shards = [x.stats for x in self.shards]
+        ret = {x: (max if 'latency' in x or x == 'wait' else sum)(y[x] for y in shards) for x in shards[0]}
+        ret.update(
+            published=self.published
+            , publish_errors=self.publish_errors
+            , flush_latency=self.flush_latency
+            , avg_flush_latency=self._flush_latency_total / self.batches if self.batches else 0.0
+            , max_flush_latency=self.max_flush_latency
+            , queue_depth=self.queue_depth
+            , shards=shards
+        )
+        return ret
+
+    @property
+    def queue_depth(self) -> int:
+        return len(self._out_queue)
+
+    def get_out_topic(self, state: State) -> str:
+        key = (state.thing.unique_id, state.name)
+        topic = self._out_topics.get(key)
+        if topic is None:
+            topic = self._out_topics[key] = self.out_topic.format(
+                app_name=self.app.name, thing_id=key[0], state_name=key[1])
+        return topic
 
     async def push(self, state: State, **data):
         logger.debug(f'push {state}')
-        await self.mqtt.publish(
-            topic=DEF_OUT_TOPIC.format(app_name=self.app.name, thing_id=state.thing.unique_id, state_name=state.name)
-            , message=str(state.value).encode()
-        )
+        self._out_queue[(state.thing.unique_id, state.name)] = (state, str(state.value).encode())
+        self._out_ready.set()
+        if metrics.enabled:
+            BINDING_PUSHES.labels(self.name).inc()
+            MQTT_OUT_QUEUE.labels(self.name).set(len(self._out_queue))
+
+    async def flush(self):
+        """
+        Publish everything from outbound queue in batches of max_batch, at most max_in_flight publishes at a time.
+        Messages are removed from the queue only after they are published (unless state was pushed again meanwhile),
+        so that nothing is lost if flush is cancelled. Messages that failed stay in the queue, the next flush is
+        scheduled for them after retry delay (with backoff), so they are retried even if nothing is pushed
+        :return:
+        """
+        sem = asyncio.Semaphore(self.max_in_flight)
+
+        async def publish(state: State, message: bytes):
+            async with sem:
+                await self.shard_of(state.thing.unique_id).client.publish(
+                    topic=self.get_out_topic(state), message=message)
+
+        self._out_ready.clear()
+        pending = list(self._out_queue.items())
+        failed = 0
+        for i in range(0, len(pending), self.max_batch):
+            batch = pending[i:i + self.max_batch]
+            started = time.perf_counter()
+            res = await asyncio.gather(*[publish(state, message) for _, (state, message) in batch]
+                                       , return_exceptions=True)
+            self._add_flush_latency(time.perf_counter() - started)
+            for (key, item), err in zip(batch, res):
+                if isinstance(err, Exception):
+                    self.publish_errors += 1
+                    failed += 1
+                    logger.error(f'{self} could not publish {item[0]}: {err}')
+                    continue
+                self.published += 1
+                if self._out_queue.get(key) is item:
+                    del self._out_queue[key]
+        if failed:
+            self._schedule_retry()
+        elif pending:
+            self._next_retry_delay = 0
+        if metrics.enabled:
+            MQTT_OUT_QUEUE.labels(self.name).set(len(self._out_queue))
+
+    def _schedule_retry(self):
+        if self._retry is not None:
+            self._retry.cancel()
+        if self._next_retry_delay:
+            self._next_retry_delay = min(self._next_retry_delay * 2, DEF_MAX_RETRY_DELAY)
+        else:
+            self._next_retry_delay = self.retry_delay
+        logger.debug(f'{self} retries {len(self._out_queue)} messages in {self._next_retry_delay}s')
+        self._retry = asyncio.get_event_loop().call_later(self._next_retry_delay, self._out_ready.set)
+
+    def _add_flush_latency(self, latency: float):
+        self.batches += 1
+        self.flush_latency = latency
+        self._flush_latency_total += latency
+        if latency > self.max_flush_latency:
+            self.max_flush_latency = latency
+
+    @autils.endless_loop
+    @autils.set_logger(logger)
+    async def _flush_loop(self):
+        await self._out_ready.wait()
+        if self.flush_window:
+            await asyncio.sleep(self.flush_window)
+        await self.flush()
 
     async def start_binding(self) -> bool:
         global _cnt
-        await self.mqtt.connect(self.uri)
-        await self.mqtt.subscribe([(self.subs_topic, mqtt_const.QOS_0)])
-        logger.debug(f'{self.name} connected and suscribed to {self.subs_topic}')
-        self._tasks.append(await self._loop())
+        self.build_routes()
+        if len(self.shards) == 1:
+            self.shards[0].topics = [self.subs_topic]
+        else:
+            for x in self.shards:
+                x.topics = []
+            for topic, state in self.addresses.items():
+                self.shard_of(state.thing.unique_id).topics.append(topic)
+        for tasks in await asyncio.gather(*[x.start() for x in self.shards]):
+            self._tasks.extend(tasks)
+        logger.debug(f'{self.name} connected with {len(self.shards)} shards')
+        self._tasks.append(await self._flush_loop())
         return True
 
-    @autils.endless_loop
-    @autils.set_logger(logger)
-    async def _loop(self):
-        msg = await self.mqtt.deliver_message()
-        await self.handle_msg(msg)
+    def get_address(self, state: State, data: dict) -> Optional[str]:
+        """
+        Full incoming topic of state, known topics are resolved with one dict lookup
+        """
+        if self._app is None:
+            return None
+        return self.in_topic.format(app_name=self.app.name, thing_id=state.thing.unique_id, state_name=state.name)
 
-    async def handle_msg(self, msg: ApplicationMessage):
-        logger.debug(f'{self} handle {msg.topic}: {msg.data}')
-        match = self.parse_topic.match(msg.topic)
-        if match is not None:
-            thing_id = match.groupdict().get(THING_ID)
+    def build_routes(self):
+        """
+        Add topics of states, that were subscribed before binding was connected to the app
+        :return:
+        """
+        for (thing_id, state_name), state in self.subscriptions.items():
+            topic = self.in_topic.format(app_name=self.app.name, thing_id=thing_id, state_name=state_name)
+            self.addresses.setdefault(topic, state)
+        self._route_cache.clear()
+
+    def route(self, topic: str) -> Optional[State]:
+        """
+        Find state subscribed to topic. Topics missing in routing table are parsed once and then kept in LRU-cache
+        :param topic:
+        :return: State or None if topic can not be routed
+        """
+        state = self.addresses.get(topic)
+        if state is not None:
+            return state
+        try:
+            state = self._route_cache[topic]
+        except KeyError:
+            state = self._parse_route(topic)
+            self._route_cache[topic] = state
+            if len(self._route_cache) > self.route_cache_size:
+                self._route_cache.popitem(last=False)
         else:
-            warnings.warn(f'{self} could not parse {msg.topic}')
-            return
-        if thing_id is None:
-            warnings.warn(f'{self} could not parse {msg.topic} using {self.parse_topic}')
+            self._route_cache.move_to_end(topic)
+        return state
+
+    def _parse_route(self, topic: str) -> Optional[State]:
+        match = self.parse_topic.match(topic)
+        if match is None:
+            warnings.warn(f'{self} could not parse {topic} using {self.parse_topic}')
             return
-        state_name = match.groupdict().get(STATE_NAME)
-        if state_name is None:
-            warnings.warn(f'{msg.topic} does not contain {STATE_NAME}')
+        groups = match.groupdict()
+        return self.subscriptions.get((groups[THING_ID], groups[STATE_NAME]))
+
+    async def handle_msg(self, msg: ApplicationMessage):
+        """
+        Route message by its topic and pass it to subscribed state
+        :param msg:
+        :return:
+        """
+        logger.debug(f'{self} handle {msg.topic}: {msg.data}')
+        state = self.route(msg.topic)
+        if state is None:
+            warnings.warn(f'{msg.topic} is not found or not binded to {self.name}')
             return
-        await self.trigger_subscription(thing_id, state_name, value=msg.data.decode())
+        await self._handle_routed(state, msg)
 
-    async def stop_binding(self):
-        await self.mqtt.unsubscribe([self.subs_topic])
+    async def _handle_routed(self, state: State, msg: ApplicationMessage):
+        """
+        Pass message, already routed, to its state. Shard workers call it directly, so messages of one thing are
+        handled in order
+        :param state:
+        :param msg:
+        :return:
+        """
+        if not metrics.enabled:
+            return await self.trigger_state(state, value=msg.data)
+        MQTT_RECEIVED.inc()
+        started = time.perf_counter()
         try:
-            while True:
-                task: asyncio.Future = self.mqtt.client_tasks.pop()
-                task.cancel()
-        except IndexError as err:
-            pass
-        await self.mqtt.disconnect()
+            await self.trigger_state(state, value=msg.data)
+        finally:
+            MQTT_HANDLE_SECONDS.observe(time.perf_counter() - started)
+
+    async def stop_binding(self):
+        await self.flush()
+        # messages, that failed to publish with the last flush, are not retried after stop
+        if self._retry is not None:
+            self._retry.cancel()
+            self._retry = None
+        await asyncio.gather(*[x.stop() for x in self.shards])
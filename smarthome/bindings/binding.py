@@ -2,7 +2,8 @@ from ..const import _T
 from ..thing import Thing, Group
 from ..state import State
 from ..utils.mixins import _MixRules
-from typing import List, Callable, Dict, Generic, DefaultDict, Tuple
+from ..metrics import registry as metrics, BINDING_TRIGGERS
+from typing import List, Callable, Dict, Generic, DefaultDict, Tuple, Hashable, Optional
 from logging import getLogger, Logger
 import asyncio
 from threading import Lock
@@ -20,6 +21,8 @@ class Binding(Generic[_T], _MixRules):
 
     # if you want to protect binding from push after updates, set it to False
     eho_safe: bool = False
+    # seconds to wait for start_binding, App.binding_timeout is used if None
+    start_timeout: float = None
 
     def __repr__(self):
         return self.__str__()
@@ -31,9 +34,12 @@ class Binding(Generic[_T], _MixRules):
         from ..app import App
         from .. import State
         obj = object.__new__(cls)
-        obj.subscribe_data: Dict[Thing, dict] = {}
+        obj.subscribe_data: Dict[Tuple[str, str], dict] = {}
         #  subscriptions are asyncio.Condition, keys are thing_id, state_name
         obj.subscriptions: Dict[Tuple[str, str], State] = {}
+        # reverse indexes, filled by register: thing_id -> thing, binding-specific address -> state
+        obj.things: Dict[str, Thing] = {}
+        obj.addresses: Dict[Hashable, State] = {}
         obj._app: App = None
         return obj
 
@@ -45,21 +51,62 @@ class Binding(Generic[_T], _MixRules):
 
     async def trigger_subscription(self, thing_id: str, state_name: str, value, is_command=False):
         logger.debug(f'Trigger {thing_id}.{state_name} = {value} from {self.name}')
+        if metrics.enabled:
+            BINDING_TRIGGERS.labels(self.name).inc()
         state = self.subscriptions.get((thing_id, state_name), None)
         if state is None:
             warnings.warn(f'{thing_id}.{state_name} is not found or not binded to {self.name}')
             return
+        await self.trigger_state(state, value, is_command=is_command)
+
+    async def trigger_state(self, state: State, value, is_command=False):
+        """
+        Pass value to already resolved state, use it when binding has its own way to find subscribed state
+        :param state:
+        :param value:
+        :param is_command: if True, command is sent to state, otherwise update
+        :return:
+        """
         if is_command:
             await state.command(value, _from=self)
         else:
             await state.update(value, _from=self)
 
+    def register(self, thing: Thing, state_name: str, state: State, data: dict):
+        """
+        Called by Thing.bind_to for every subscribed state, keeps binding's indexes up to date
+        :param thing:
+        :param state_name:
+        :param state:
+        :param data: keyword arguments passed to bind_to
+        :return:
+        """
+        key = (thing.unique_id, state_name)
+        self.subscriptions[key] = state
+        self.subscribe_data[key] = data
+        self.things[thing.unique_id] = thing
+        address = self.get_address(state, data)
+        if address is not None:
+            self.addresses[address] = state
+
+    def get_address(self, state: State, data: dict) -> Optional[Hashable]:
+        """
+        Binding-specific address of subscribed state (eg mqtt topic), inbound events are resolved with resolve(address)
+        :param state:
+        :param data: keyword arguments passed to bind_to
+        :return: address or None if state has no address
+        """
+        return None
+
+    def resolve(self, address: Hashable) -> Optional[State]:
+        return self.addresses.get(address)
+
     def get_subscribed_thing(self, thing_id: str) -> Thing:
         warnings.warn('get_subscribed_thing', DeprecationWarning)
-        for x in self.subscribe_data.keys():
-            if x.unique_id == thing_id:
-                return x
-        logger.warning(f'Could not find {thing_id} in {self}')
+        ret = self.things.get(thing_id)
+        if ret is None:
+            logger.warning(f'Could not find {thing_id} in {self}')
+        return ret
 
 
     async def thing_request(self, thing: Thing) -> dict:
@@ -2,6 +2,7 @@ from megad import Mega, Relay, Servo, SpeedSelect, OneWireBus
 from .binding import Binding, logger
 from .. import things
 from ..state import State
+from ..metrics import registry as metrics, BINDING_PUSHES
 import warnings
 from .. import const
 from typing import Callable
@@ -29,33 +30,41 @@ class MegaBinding(Binding):
             self.devices[id] = dev = factory(*args, **kwargs)
             return dev
 
+    def get_address(self, state: State, data: dict):
+        # for buttons
+        if isinstance(state.thing, things.Button):
+            key = data.get('input')
+            if key is None:
+                raise RuntimeError(f'{self.name} binding can not map a callback for button {state.thing.unique_id}'
+                                   f', "input" keyword is not provided')
+            return 'input', key
+        # for temperatures
+        elif isinstance(state.thing, things.Temperature):
+            if self.ow_bus is None:
+                raise RuntimeError(f'Try to bind {state.thing.unique_id} to mega OneWire, but OneWire is not set'
+                                   f', provide "ow_port" to binding')
+            addr = data.get('addr')
+            if addr is None:
+                raise RuntimeError(f'{self.name} binding can not map a callback for temp {state.thing.unique_id}'
+                                   f', "addr" keyword is not provided')
+            return 'addr', addr
+
+    def map_callback(self, address, state: State):
+        kind, key = address
+        if kind == 'input':
+            @self.mega.map_callback_deco(key)
+            async def callback(*args):
+                await state.notify_changed()
+        else:
+            @self.ow_bus.map_callback_deco(key)
+            async def callback(temp: float):
+                await state.update(value=temp, _from=self)
+
     async def start_binding(self) -> bool:
 
         # map callbacks
-        for key, val in self.subscriptions.items():
-            # for buttons
-            if isinstance(val.thing, things.Button):
-                _key = self.subscribe_data[key].get('input')
-                if _key is None:
-                    raise RuntimeError(f'{self.name} binding can not map a callback for button {key}'
-                                       f', "input" keyword is not provided')
-
-                @self.mega.map_callback_deco(_key)
-                async def callback(*args):
-                    await val.notify_changed()
-
-            # for temperatures
-            elif isinstance(val.thing, things.Temperature):
-                if self.ow_bus is None:
-                    raise RuntimeError(f'Try to bind {key} to mega OneWire, but OneWire is not set, provide "ow_port" to binding')
-                addr = self.subscribe_data[key].get('addr')
-                if addr is None:
-                    raise RuntimeError(f'{self.name} binding can not map a callback for temp {key}'
-                                       f', "addr" keyword is not provided')
-
-                @self.ow_bus.map_callback_deco(addr)
-                async def callback(temp: float):
-                    await val.update(value=temp, _from=self)
+        for address, state in self.addresses.items():
+            self.map_callback(address, state)
 
         # start inputs listener
         await self.mega.start_listen(port=self.port)
@@ -77,6 +86,8 @@ class MegaBinding(Binding):
         await self.mega.stop()
 
     async def push(self, state: State, **data):
+        if metrics.enabled:
+            BINDING_PUSHES.labels(self.name).inc()
         pin: int = data.get('pin')
         is_servo: bool = 'dir_rel' in data
         is_speed: bool = 'pins' in data
@@ -0,0 +1,85 @@
+import typing
+import weakref
+
+from . import expression
+from .const import logger, Logger
+
+logger: Logger = logger.getChild('computed')
+
+
+class Cell(object):
+    """
+    Cached value of computed state. Cell is recomputed on read only if it is dirty.
+    Cell is kept alive by its computed state and by cells depending on it, sources keep only weak references to it
+    """
+    __slots__ = ('compute', 'value', 'dirty', 'dependents', 'computations', '__weakref__')
+
+    def __init__(self, compute: typing.Callable[[], typing.Any]):
+        self.compute = compute
+        self.value = None
+        self.dirty = True
+        self.dependents: typing.MutableSet[Cell] = weakref.WeakSet()
+        self.computations = 0
+
+    def get(self):
+        if self.dirty:
+            self.value = self.compute()
+            self.dirty = False
+            self.computations += 1
+        return self.value
+
+
+class CellRef(expression.Node):
+    """
+    Value of computed state, it is read from the cell, not recomputed from sources
+    """
+    __slots__ = ('cell', '_sources')
+
+    def __init__(self, cell: Cell, sources: tuple):
+        self.cell = cell
+        self._sources = sources
+
+    @property
+    def sources(self) -> tuple:
+        return self._sources
+
+    def render(self, names: expression._Names) -> str:
+        return f'{names.bind(self.cell)}.get()'
+
+
+def invalidate(cells: typing.Iterable[Cell]):
+    """
+    Mark cells and everything depending on them dirty, going down the graph, every cell is marked once
+    """
+    stack = list(cells)
+    while stack:
+        cell = stack.pop()
+        if not cell.dirty:
+            cell.dirty = True
+            stack.extend(cell.dependents)
+
+
+class DependencyGraph(object):
+    """
+    Cells of computed states and their dependencies: states and another cells.
+    Cells depending on a state directly are kept by the state itself, its value setter invalidates them, so any write
+    of the value (change, update, restore from store or plain assignment) marks the cells dirty before anything
+    can read them. Every cell is recomputed once on the next read. Clean cell never depends on dirty one.
+    Dependents are weak sets, so computed states made at runtime (eg in a rule) are dropped from the graph with them
+    """
+
+    def add(self, node: expression.Node) -> Cell:
+        cell = Cell(node.compile('value'))
+        for x in node.walk():
+            if isinstance(x, expression.Ref):
+                if not x.state._dependents:
+                    x.state._dependents = weakref.WeakSet()
+                x.state._dependents.add(cell)
+            elif isinstance(x, CellRef):
+                x.cell.dependents.add(cell)
+        return cell
+
+    invalidate = staticmethod(invalidate)
+
+
+graph = DependencyGraph()
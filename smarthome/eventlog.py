@@ -0,0 +1,270 @@
+import asyncio
+import glob
+import json
+import mmap
+import os
+import struct
+import time
+import typing
+from concurrent.futures.thread import ThreadPoolExecutor
+
+from asyncio_primitives import utils as autils
+
+from .const import logger, Logger
+from .events import bus, EventBus, CHANGED, RECEIVED_UPDATE, RECEIVED_COMMAND
+
+if typing.TYPE_CHECKING:
+    from .thing import Thing
+    from .state import State
+    from .bindings.binding import Binding
+
+logger: Logger = logger.getChild('eventlog')
+
+# seconds between fsyncs of the current segment
+DEF_FSYNC_INTERVAL = 1
+# new segment is started when current one grows bigger
+DEF_SEGMENT_SIZE = 16 * 1024 * 1024
+
+MAGIC = b'SHEL\x01'
+# total record size, monotonic timestamp, event, lengths of thing_id, state_name, value, source
+_HEADER = struct.Struct('<IdBHHIH')
+_EVENTS = (CHANGED, RECEIVED_UPDATE, RECEIVED_COMMAND)
+_EVENT_CODES = {x: i for i, x in enumerate(_EVENTS)}
+_SEGMENT = 'events-{:06d}.log'
+
+
+class Record(typing.NamedTuple):
+    ts: float
+    event: str
+    thing_id: str
+    state_name: str
+    value: typing.Any
+    source: str
+
+
+def _source_name(_from) -> str:
+    if _from is None:
+        return ''
+    if isinstance(_from, str):
+        return _from
+    return getattr(_from, 'name', None) or _from.__class__.__name__
+
+
+def pack(ts: float, event: str, thing_id: str, state_name: str, value, source: str) -> bytes:
+    parts = [x.encode() for x in (thing_id, state_name, json.dumps(value, default=str), source)]
+    size = _HEADER.size + sum(len(x) for x in parts)
+    return _HEADER.pack(size, ts, _EVENT_CODES[event], *(len(x) for x in parts)) + b''.join(parts)
+
+
+def read_segment(path: str) -> typing.Iterator[Record]:
+    """
+    Read records of segment, segment is memory-mapped, so it is not loaded into memory at once.
+    Truncated record at the end (eg after crash) is ignored
+    """
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size <= len(MAGIC):
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+            if buf[:len(MAGIC)] != MAGIC:
+                raise ValueError(f'{path} is not an event log segment')
+            offset = len(MAGIC)
+            end = len(buf)
+            while offset + _HEADER.size <= end:
+                size, ts, code, *lengths = _HEADER.unpack_from(buf, offset)
+                if offset + size > end:
+                    logger.warning(f'{path} is truncated at {offset}')
+                    return
+                pos = offset + _HEADER.size
+                fields = []
+                for length in lengths:
+                    fields.append(buf[pos:pos + length].decode())
+                    pos += length
+                thing_id, state_name, value, source = fields
+                yield Record(ts, _EVENTS[code], thing_id, state_name, json.loads(value), source)
+                offset += size
+
+
+def segments(path: str) -> typing.List[str]:
+    return sorted(glob.glob(os.path.join(path, _SEGMENT.replace('{:06d}', '*'))))
+
+
+def read(path: str) -> typing.Iterator[Record]:
+    """
+    Read all the records from the log directory, in order
+    """
+    for x in segments(path):
+        yield from read_segment(x)
+
+
+class EventLog(object):
+    """
+    Append-only binary log of states' events: changes, updates and commands are written with thing id, state name,
+    value, source and monotonic timestamp to segment files in the directory path.
+    Records are appended to file buffer in the event callback, file is fsynced every fsync_interval seconds.
+    fsync and closing of full segments are done in a separate thread, one by one, so they do not block the loop
+
+    ```
+    log = EventLog('/var/log/smarthome')
+    log.attach(*app.get_things())
+    task = await log.start()
+    ...
+    await log.close()
+    await replay(binding, '/var/log/smarthome', speed=10)
+    ```
+    """
+
+    def __init__(self
+                 , path: str
+                 , fsync_interval: float = DEF_FSYNC_INTERVAL
+                 , segment_size: int = DEF_SEGMENT_SIZE
+                 , events: typing.Sequence[str] = _EVENTS
+                 , _bus: EventBus = None
+                 ):
+        self.path = path
+        self.fsync_interval = fsync_interval
+        self.segment_size = segment_size
+        self.events = events
+        self._bus = _bus or bus
+        self._file: typing.BinaryIO = None
+        self._segment = 0
+        self._size = 0
+        self._dirty = False
+        self._attached: typing.List['State'] = []
+        # thread of fsyncs, it is started on the first use and stopped by close, so that log can be reopened
+        self._executor: ThreadPoolExecutor = None
+        # counters
+        self.written = 0
+        self.fsyncs = 0
+
+    def __str__(self):
+        return f'EventLog <{self.path}>'
+
+    def attach(self, *things: 'Thing'):
+        for thing in things:
+            for state in thing.states.values():
+                for event in self.events:
+                    self._bus.subscribe(state, event, self._on_event)
+                self._attached.append(state)
+
+    def detach(self):
+        for state in self._attached:
+            for event in self.events:
+                self._bus.unsubscribe(state, event, self._on_event)
+        self._attached.clear()
+
+    def _on_event(self, state: 'State', event: str, _from):
+        self.write(event, state.thing.unique_id, state.name, state.value, _source_name(_from))
+
+    def write(self, event: str, thing_id: str, state_name: str, value, source: str = '', ts: float = None):
+        if self._file is None or self._size >= self.segment_size:
+            self._roll()
+        data = pack(time.monotonic() if ts is None else ts, event, thing_id, state_name, value, source)
+        self._file.write(data)
+        self._size += len(data)
+        self._dirty = True
+        self.written += 1
+
+    async def _run(self, foo, *args):
+        return await asyncio.get_event_loop().run_in_executor(self._get_executor(), foo, *args)
+
+    def _get_executor(self) -> ThreadPoolExecutor:
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=1)
+        return self._executor
+
+    def _close_segment(self, file: typing.BinaryIO):
+        """
+        Fsync and close segment, runs in the log's thread
+        """
+        try:
+            os.fsync(file.fileno())
+        except OSError as err:
+            logger.error(f'{self} could not fsync {file.name}: {err}')
+        finally:
+            file.close()
+
+    def _roll(self):
+        """
+        Close current segment and start the next one. Full segment is fsynced and closed in the log's thread, after
+        fsyncs that are already pending
+        """
+        if self._file is not None:
+            self._file.flush()
+            self._get_executor().submit(self._close_segment, self._file)
+            self._dirty = False
+            self.fsyncs += 1
+        else:
+            os.makedirs(self.path, exist_ok=True)
+            existing = segments(self.path)
+            if existing:
+                self._segment = int(os.path.basename(existing[-1])[len('events-'):-len('.log')])
+        self._segment += 1
+        self._file = open(os.path.join(self.path, _SEGMENT.format(self._segment)), 'wb')
+        self._file.write(MAGIC)
+        self._size = len(MAGIC)
+
+    async def sync(self):
+        """
+        Flush file buffer and fsync current segment in the log's thread
+        """
+        if self._file is not None and self._dirty:
+            self._file.flush()
+            # records written meanwhile make it dirty again
+            self._dirty = False
+            await self._run(os.fsync, self._file.fileno())
+            self.fsyncs += 1
+
+    @autils.endless_loop
+    @autils.set_logger(logger)
+    async def _sync_loop(self):
+        await asyncio.sleep(self.fsync_interval)
+        await self.sync()
+
+    async def start(self) -> asyncio.Task:
+        """
+        Start periodic fsync
+        :return: task of fsync loop
+        """
+        return await self._sync_loop()
+
+    async def close(self):
+        """
+        Fsync and close current segment and stop the log's thread
+        """
+        self.detach()
+        if self._file is not None:
+            file, self._file = self._file, None
+            file.flush()
+            await self._run(self._close_segment, file)
+            self.fsyncs += 1
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+
+
+async def replay(binding: 'Binding'
+                 , path: str
+                 , speed: float = 1
+                 , events: typing.Sequence[str] = (RECEIVED_UPDATE, RECEIVED_COMMAND)
+                 ) -> int:
+    """
+    Feed recorded events back through binding.trigger_subscription, states must be subscribed to binding.
+    Only updates and commands are replayed by default, changes are their consequences
+    :param binding:
+    :param path: directory of the log
+    :param speed: 1 - original speed, 10 - ten times faster, None or 0 - as fast as possible
+    :param events:
+    :return: number of replayed events
+    """
+    cnt = 0
+    last: float = None
+    for x in read(path):
+        if x.event not in events:
+            continue
+        if speed and last is not None and x.ts > last:
+            await asyncio.sleep((x.ts - last) / speed)
+        last = x.ts
+        await binding.trigger_subscription(x.thing_id, x.state_name, x.value
+                                           , is_command=x.event == RECEIVED_COMMAND)
+        cnt += 1
+    return cnt
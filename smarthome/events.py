@@ -0,0 +1,269 @@
+import asyncio
+import inspect
+import time
+import typing
+import weakref
+from collections import deque
+from functools import wraps
+
+from asyncio_primitives import utils as autils
+
+from .const import logger, Logger
+from .metrics import registry as metrics, RULE_RUNS, RULE_ERRORS, RULE_SECONDS
+
+logger: Logger = logger.getChild('events')
+
+CHANGED = 'changed'
+RECEIVED_UPDATE = 'received_update'
+RECEIVED_COMMAND = 'received_command'
+
+EventCallback = typing.Callable[[typing.Any, str, typing.Any], typing.Optional[typing.Awaitable]]
+
+
+class Event(typing.NamedTuple):
+    """
+    Key of the subscription: object that fires event and event name
+    """
+    source: typing.Any
+    name: str
+
+
+def union(*groups: typing.Iterable[Event]) -> typing.Tuple[Event, ...]:
+    """
+    Merge several groups of events keeping the order, sources are compared by identity
+    :param groups:
+    :return:
+    """
+    seen = set()
+    ret = []
+    for group in groups:
+        for x in group:
+            key = (id(x.source), x.name)
+            if key not in seen:
+                seen.add(key)
+                ret.append(x)
+    return tuple(ret)
+
+
+class EventBus(object):
+    """
+    In-process pub/sub. Subscribers are kept in one registry keyed by source and event, they are called synchronously
+    with (source, event, _from), awaitables returned by them are awaited together.
+    Sources are referenced weakly (by id, the entry is dropped when source is collected), so the bus does not keep
+    states alive. Publishing an event without subscribers costs one dict lookup
+    """
+
+    def __init__(self):
+        # id(source) -> event -> callbacks
+        self._subscribers: typing.Dict[int, typing.Dict[str, typing.List[EventCallback]]] = {}
+        self._finalizers: typing.Dict[int, weakref.finalize] = {}
+
+    def subscribe(self, source, event: str, callback: EventCallback, first=False) -> EventCallback:
+        """
+        :param source: any object, that supports weak references
+        :param first: if True, callback is called before already subscribed ones
+        """
+        key = id(source)
+        by_event = self._subscribers.get(key)
+        if by_event is None:
+            by_event = self._subscribers[key] = {}
+            self._finalizers[key] = weakref.finalize(source, self._forget, key)
+        subscribers = by_event.setdefault(event, [])
+        if first:
+            subscribers.insert(0, callback)
+        else:
+            subscribers.append(callback)
+        return callback
+
+    def subscribe_queue(self, source, event: str, queue: asyncio.Queue) -> EventCallback:
+        """
+        Put (source, event, _from) to queue every time event is published
+        :return: callback, that can be passed to unsubscribe
+        """
+        def put(*args):
+            queue.put_nowait(args)
+        return self.subscribe(source, event, put)
+
+    def unsubscribe(self, source, event: str, callback: EventCallback):
+        key = id(source)
+        by_event = self._subscribers.get(key)
+        subscribers = by_event and by_event.get(event)
+        if subscribers is None:
+            return
+        try:
+            subscribers.remove(callback)
+        except ValueError:
+            return
+        if not subscribers:
+            del by_event[event]
+            if not by_event:
+                del self._subscribers[key]
+                self._finalizers.pop(key).detach()
+
+    def _forget(self, key: int):
+        self._subscribers.pop(key, None)
+        self._finalizers.pop(key, None)
+
+    def has_listeners(self, source, event: str) -> bool:
+        by_event = self._subscribers.get(id(source))
+        return by_event is not None and event in by_event
+
+    async def publish(self, source, event: str, _from=None):
+        by_event = self._subscribers.get(id(source))
+        if by_event is None:
+            return
+        subscribers = by_event.get(event)
+        if not subscribers:
+            return
+        pending = []
+        for callback in tuple(subscribers):
+            ret = callback(source, event, _from)
+            if ret is not None and inspect.isawaitable(ret):
+                pending.append(ret)
+        if len(pending) == 1:
+            await pending[0]
+        elif pending:
+            await asyncio.gather(*pending)
+
+
+bus = EventBus()
+
+
+class Subscription(asyncio.Future):
+    """
+    Future, that stays pending while subscription is active. Cancel it to unsubscribe, unsubscription happens
+    immediately, not on the next loop iteration
+    """
+
+    def __init__(self, unsubscribe: typing.Callable[[], None]):
+        super().__init__()
+        self._unsubscribe = unsubscribe
+
+    def cancel(self, *args, **kwargs):
+        if not self.done():
+            self._unsubscribe()
+        return super().cancel(*args, **kwargs)
+
+
+def rule_name(foo: typing.Callable) -> str:
+    """
+    Name of rule in metrics: name given with autils.set_name (eg "push switch.lamp.is_on->mqtt"), so that generated
+    rules are told apart, qualified name of function otherwise
+    :param foo:
+    :return:
+    """
+    name = getattr(foo, '_name', None)
+    if name:
+        return name
+    if foo.__name__ != foo.__qualname__.rsplit('.', 1)[-1]:
+        # function was renamed
+        return foo.__name__
+    return foo.__qualname__
+
+
+def rule(*events: Event
+         , check: typing.Callable[[], bool] = None
+         , edge: bool = False
+         , release: typing.Callable[[], bool] = None
+         , hold: float = None
+         , _bus: EventBus = None):
+    """
+    Make rule from events: foo is called every time any of events is published and check returns True.
+    foo runs in a task of the rule, so publisher (eg State.change) does not wait for it. Runs of one rule do not
+    overlap: events that come while foo is running are queued and foo is called for them one by one, in order.
+    Decorated foo is a starter: await it to subscribe, it returns future, cancel the future to unsubscribe, queued
+    runs and the run that is not finished yet are cancelled too
+    :param events:
+    :param check:
+    :param edge: if True, foo is called only when check turns from False to True, not on every event while it is True
+    :param release: for edge-rules: while condition is True, release is checked instead of check, use it for hysteresis
+    :param hold: for edge-rules: condition must stay True for hold seconds before foo is called
+    :return:
+    """
+    _bus = _bus or bus
+
+    def deco(foo):
+        name = rule_name(foo)
+
+        @wraps(foo)
+        @autils.mark_starter
+        async def wrapper(*args, **kwargs):
+            last = False
+            held: asyncio.Handle = None
+            # events waiting for the current run to finish, they are handled by one worker task
+            pending: typing.Deque[typing.Tuple[typing.Any, str]] = deque()
+            worker: asyncio.Task = None
+
+            async def run(source, event):
+                if metrics.enabled:
+                    return await measured(source, event)
+                try:
+                    await autils.async_run(foo, *args, **kwargs)
+                except Exception as err:
+                    logger.exception(f'{foo.__name__} failed on {event} of {source}: {err}')
+
+            async def measured(source, event):
+                RULE_RUNS.labels(name).inc()
+                started = time.perf_counter()
+                try:
+                    await autils.async_run(foo, *args, **kwargs)
+                except Exception as err:
+                    RULE_ERRORS.labels(name).inc()
+                    logger.exception(f'{foo.__name__} failed on {event} of {source}: {err}')
+                finally:
+                    RULE_SECONDS.labels(name).observe(time.perf_counter() - started)
+
+            async def drain():
+                nonlocal worker
+                try:
+                    while pending:
+                        await run(*pending.popleft())
+                finally:
+                    worker = None
+
+            def spawn(source, event):
+                nonlocal worker
+                pending.append((source, event))
+                if worker is None:
+                    worker = asyncio.ensure_future(drain())
+
+            def fire(source, event):
+                nonlocal held
+                held = None
+                spawn(source, event)
+
+            def callback(source, event, _from):
+                if check is None or check():
+                    spawn(source, event)
+
+            def edge_callback(source, event, _from):
+                nonlocal last, held
+                current = bool((release if last and release is not None else check)())
+                if current is last:
+                    return
+                last = current
+                if not current:
+                    if held is not None:
+                        held.cancel()
+                        held = None
+                elif hold:
+                    held = asyncio.get_event_loop().call_later(hold, fire, source, event)
+                else:
+                    spawn(source, event)
+
+            _callback = edge_callback if edge and check is not None else callback
+            for x in events:
+                _bus.subscribe(x.source, x.name, _callback)
+
+            def unsubscribe():
+                for x in events:
+                    _bus.unsubscribe(x.source, x.name, _callback)
+                if held is not None:
+                    held.cancel()
+                pending.clear()
+                if worker is not None and worker is not asyncio.current_task():
+                    worker.cancel()
+
+            return Subscription(unsubscribe)
+        return wrapper
+    return deco
@@ -0,0 +1,153 @@
+import typing
+
+
+class _Names(object):
+    """
+    Gives every object used in expression a local name of the compiled function
+    """
+
+    def __init__(self):
+        self.names: typing.Dict[int, str] = {}
+        self.values: typing.Dict[str, typing.Any] = {}
+
+    def bind(self, obj) -> str:
+        name = self.names.get(id(obj))
+        if name is None:
+            name = self.names[id(obj)] = f'_{len(self.names)}'
+            self.values[name] = obj
+        return name
+
+
+class Node(object):
+    """
+    Node of State expression. Expression is built by State operators and compiled once into a flat function without
+    arguments, so evaluating it costs only attribute reads of source states
+    """
+    __slots__ = ()
+
+    @property
+    def sources(self) -> tuple:
+        """
+        States, which values are used in expression
+        """
+        return ()
+
+    def walk(self) -> typing.Iterator['Node']:
+        yield self
+
+    def render(self, names: _Names) -> str:
+        raise NotImplementedError
+
+    def compile(self, name: str = 'expr') -> typing.Callable[[], typing.Any]:
+        names = _Names()
+        src = self.render(names)
+        args = ', '.join(f'{x}={x}' for x in names.values)
+        code = f'def {name}({args}):\n    return {src}\n'
+        namespace = dict(names.values)
+        exec(code, namespace)
+        ret = namespace[name]
+        ret.__source__ = code
+        return ret
+
+
+class Const(Node):
+    __slots__ = ('value', )
+
+    def __init__(self, value):
+        self.value = value
+
+    def render(self, names: _Names) -> str:
+        return names.bind(self.value)
+
+
+class Ref(Node):
+    """
+    Value of the state
+    """
+    __slots__ = ('state', )
+
+    def __init__(self, state):
+        self.state = state
+
+    @property
+    def sources(self) -> tuple:
+        return self.state,
+
+    def render(self, names: _Names) -> str:
+        return f'{names.bind(self.state)}.value'
+
+
+class Call(Node):
+    """
+    Result of calling foo without arguments, used for custom checks
+    """
+    __slots__ = ('foo', )
+
+    def __init__(self, foo: typing.Callable[[], typing.Any]):
+        self.foo = foo
+
+    def render(self, names: _Names) -> str:
+        return f'{names.bind(self.foo)}()'
+
+
+class BinOp(Node):
+    """
+    Binary operation, op is python operator: '+', '==', 'and' etc.
+    """
+    __slots__ = ('op', 'left', 'right', '_sources')
+
+    OPERATORS = ('+', '-', '*', '/', '==', '!=', '<=', '<', '>=', '>', 'and', 'or')
+
+    def __init__(self, op: str, left: Node, right: Node):
+        assert op in self.OPERATORS, f'unknown operator {op}'
+        self.op = op
+        self.left = left
+        self.right = right
+        self._sources = sources(left, right)
+
+    @property
+    def sources(self) -> tuple:
+        return self._sources
+
+    def walk(self) -> typing.Iterator[Node]:
+        yield self
+        yield from self.left.walk()
+        yield from self.right.walk()
+
+    def render(self, names: _Names) -> str:
+        return f'({self.left.render(names)} {self.op} {self.right.render(names)})'
+
+
+def relax(node: Node, hysteresis: float) -> Node:
+    """
+    Make release condition for rule with hysteresis: comparisons with thresholds are shifted by hysteresis, so that
+    once condition is true, it stays true until value moves hysteresis away from the threshold.
+    Eg "x <= 20" with hysteresis 0.5 is released when x > 20.5
+    """
+    if not isinstance(node, BinOp):
+        return node
+    if node.op in ('and', 'or'):
+        return BinOp(node.op, relax(node.left, hysteresis), relax(node.right, hysteresis))
+    elif node.op in ('<=', '<'):
+        return BinOp(node.op, node.left, BinOp('+', node.right, Const(hysteresis)))
+    elif node.op in ('>=', '>'):
+        return BinOp(node.op, node.left, BinOp('-', node.right, Const(hysteresis)))
+    return node
+
+
+def unique(*groups: typing.Iterable) -> tuple:
+    """
+    Union of groups keeping the order, objects are compared by identity, as State overrides __eq__
+    """
+    seen = set()
+    ret = []
+    for group in groups:
+        for x in group:
+            if id(x) not in seen:
+                seen.add(id(x))
+                ret.append(x)
+    return tuple(ret)
+
+
+def sources(*nodes: Node) -> tuple:
+    return unique(*(x.sources for x in nodes))
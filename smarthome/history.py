@@ -0,0 +1,332 @@
+import math
+import typing
+from array import array
+from datetime import timedelta
+
+from .const import logger, Logger
+from .events import bus, EventBus, CHANGED
+
+if typing.TYPE_CHECKING:
+    from .state import State
+
+logger: Logger = logger.getChild('history')
+
+# number of raw samples kept per state
+DEF_RAW_SIZE = 1024
+# (bucket seconds, number of buckets): a day of minutes and a month of hours
+DEF_ROLLUPS = ((60, 24 * 60), (3600, 24 * 31))
+# windows are answered with the finest rollup, that needs no more than that many buckets
+MAX_WINDOW_BUCKETS = 360
+
+MEAN = 'mean'
+MIN = 'min'
+MAX = 'max'
+COUNT = 'count'
+
+_Window = typing.Union[timedelta, float]
+
+
+def _zeros(typecode: str, size: int) -> array:
+    return array(typecode, [0]) * size
+
+
+class RingBuffer(object):
+    """
+    Last size (timestamp, value) samples in two preallocated arrays of doubles
+    """
+    __slots__ = ('size', 'times', 'values', 'head', 'count')
+
+    def __init__(self, size: int):
+        self.size = size
+        self.times = _zeros('d', size)
+        self.values = _zeros('d', size)
+        # index of the next sample
+        self.head = 0
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def append(self, ts: float, value: float):
+        self.times[self.head] = ts
+        self.values[self.head] = value
+        self.head = (self.head + 1) % self.size
+        if self.count < self.size:
+            self.count += 1
+
+    def newest(self, since: float = -math.inf) -> typing.Iterator[typing.Tuple[float, float]]:
+        """
+        Samples from the newest to the oldest, while timestamp >= since
+        """
+        idx = self.head
+        for _ in range(self.count):
+            idx = (idx - 1) % self.size
+            ts = self.times[idx]
+            if ts < since:
+                return
+            yield ts, self.values[idx]
+
+
+class Rollup(object):
+    """
+    Min, max, count and time weighted sum of values per bucket of fixed duration, kept in ring of preallocated arrays.
+    Each value is weighted by how long it held: when the next sample comes, the previous value is credited to the
+    buckets it spans (at most size of them). Updating is O(1) for samples that come more often than buckets
+    """
+    __slots__ = ('bucket', 'size', 'starts', 'counts', 'sums', 'areas', 'spans', 'mins', 'maxs', 'head', 'count'
+                 , 'last_ts', 'last_value')
+
+    def __init__(self, bucket: float, size: int):
+        self.bucket = bucket
+        self.size = size
+        self.starts = _zeros('d', size)
+        self.counts = _zeros('L', size)
+        self.sums = _zeros('d', size)
+        # value * seconds held and seconds covered within bucket
+        self.areas = _zeros('d', size)
+        self.spans = _zeros('d', size)
+        self.mins = _zeros('d', size)
+        self.maxs = _zeros('d', size)
+        self.head = 0
+        self.count = 0
+        self.last_ts: typing.Optional[float] = None
+        self.last_value = 0.0
+
+    def _bucket(self, start: float, value: float) -> int:
+        """
+        Index of the bucket starting at start, the new one is opened if it is not the newest
+        """
+        last = (self.head - 1) % self.size
+        if self.count and self.starts[last] == start:
+            if value < self.mins[last]:
+                self.mins[last] = value
+            if value > self.maxs[last]:
+                self.maxs[last] = value
+            return last
+        idx = self.head
+        self.starts[idx] = start
+        self.counts[idx] = 0
+        self.sums[idx] = 0
+        self.areas[idx] = 0
+        self.spans[idx] = 0
+        self.mins[idx] = value
+        self.maxs[idx] = value
+        self.head = (idx + 1) % self.size
+        if self.count < self.size:
+            self.count += 1
+        return idx
+
+    def _hold(self, ts: float):
+        """
+        Credit the last value to the buckets from the last sample till ts
+        """
+        t = max(self.last_ts, ts - ts % self.bucket - self.bucket * (self.size - 1))
+        value = self.last_value
+        while t < ts:
+            start = t - t % self.bucket
+            end = min(ts, start + self.bucket)
+            idx = self._bucket(start, value)
+            self.areas[idx] += value * (end - t)
+            self.spans[idx] += end - t
+            t = end
+
+    def add(self, ts: float, value: float):
+        if self.last_ts is not None and ts > self.last_ts:
+            self._hold(ts)
+        idx = self._bucket(ts - ts % self.bucket, value)
+        self.counts[idx] += 1
+        self.sums[idx] += value
+        self.last_ts = ts
+        self.last_value = value
+
+    def aggregate(self, since: float, now: float, how: str) -> typing.Optional[float]:
+        """
+        Aggregate buckets, that end after since, from the newest one backwards. The last value is held till now
+        """
+        count = 0
+        total = 0.0
+        area = 0.0
+        span = 0.0
+        lo = math.inf
+        hi = -math.inf
+        idx = self.head
+        for _ in range(self.count):
+            idx = (idx - 1) % self.size
+            if self.starts[idx] + self.bucket <= since:
+                break
+            count += self.counts[idx]
+            total += self.sums[idx]
+            area += self.areas[idx]
+            span += self.spans[idx]
+            lo = min(lo, self.mins[idx])
+            hi = max(hi, self.maxs[idx])
+        if self.last_ts is not None and now > self.last_ts:
+            held = now - max(self.last_ts, since)
+            if held > 0:
+                area += self.last_value * held
+                span += held
+        return _result(how, count, lo, hi, area / span if span else total / max(count, 1))
+
+
+def _result(how: str, count: int, lo: float, hi: float, mean: float) -> typing.Optional[float]:
+    if how == COUNT:
+        return count
+    if not count:
+        return None
+    if how == MEAN:
+        return mean
+    elif how == MIN:
+        return lo
+    elif how == MAX:
+        return hi
+    raise ValueError(f'unknown aggregate {how}')
+
+
+def _raw_mean(samples: typing.Iterable[typing.Tuple[float, float]], since: float, now: float) -> float:
+    """
+    Mean of samples (from the newest to the oldest) weighted by how long each value held within [since, now]
+    """
+    area = 0.0
+    total = 0.0
+    count = 0
+    end = now
+    for ts, x in samples:
+        start = max(ts, since)
+        area += x * (end - start)
+        end = start
+        if ts < since:
+            break
+        total += x
+        count += 1
+    span = now - end
+    return area / span if span else total / max(count, 1)
+
+
+class StateHistory(object):
+    """
+    Raw samples of one state and their rollups
+    """
+
+    def __init__(self, raw_size: int = DEF_RAW_SIZE, rollups=DEF_ROLLUPS):
+        self.raw = RingBuffer(raw_size)
+        self.rollups = [Rollup(bucket, size) for bucket, size in sorted(rollups)]
+
+    def add(self, ts: float, value: float):
+        self.raw.append(ts, value)
+        for x in self.rollups:
+            x.add(ts, value)
+
+    def samples(self, since: float = -math.inf) -> typing.List[typing.Tuple[float, float]]:
+        """
+        Raw samples since timestamp, from the oldest to the newest
+        """
+        ret = list(self.raw.newest(since))
+        ret.reverse()
+        return ret
+
+    def aggregate(self, since: float, now: float, how: str = MEAN) -> typing.Optional[float]:
+        """
+        Windows shorter than the finest bucket are counted from raw samples exactly, others are answered by the
+        finest rollup, that covers window with at most MAX_WINDOW_BUCKETS buckets (with bucket precision)
+        """
+        window = now - since
+        if window < self.rollups[0].bucket:
+            values = [x for _, x in self.raw.newest(since)]
+            mean = _raw_mean(self.raw.newest(), since, now) if values and how == MEAN else 0.0
+            return _result(how, len(values), min(values, default=math.inf), max(values, default=-math.inf), mean)
+        for x in self.rollups:
+            if window <= x.bucket * min(x.size, MAX_WINDOW_BUCKETS):
+                return x.aggregate(since, now, how)
+        return self.rollups[-1].aggregate(since, now, how)
+
+
+class Recorder(object):
+    """
+    Opt-in history of states: every change of attached state is saved as (timestamp, value) in ring buffers of fixed
+    size, minute and hour rollups are updated on the way. Only numeric values are recorded (bools are 0 or 1)
+
+    ```
+    recorder = Recorder()
+    recorder.attach(temp.value)
+    ...
+    avg = recorder.aggregate(temp.value, timedelta(minutes=10))
+    ```
+    """
+
+    def __init__(self
+                 , raw_size: int = DEF_RAW_SIZE
+                 , rollups: typing.Sequence[typing.Tuple[float, int]] = DEF_ROLLUPS
+                 , clock: typing.Callable[[], float] = None
+                 , _bus: EventBus = None
+                 ):
+        """
+        :param raw_size: number of raw samples per state
+        :param rollups: (bucket seconds, number of buckets) pairs
+        :param clock: returns current timestamp, CustomTime is used by default, so recorder follows simulated time
+        """
+        assert rollups, 'at least one rollup is needed'
+        self.raw_size = raw_size
+        self.rollups = rollups
+        if clock is None:
+            from .utils.utils import CustomTime
+
+            def clock():
+                return CustomTime.now().timestamp()
+        self.clock = clock
+        self._bus = _bus or bus
+        self._history: typing.Dict['State', StateHistory] = {}
+
+    def attach(self, *states: 'State'):
+        for x in states:
+            if x in self._history:
+                continue
+            self._history[x] = StateHistory(self.raw_size, self.rollups)
+            self._bus.subscribe(x, CHANGED, self._on_change)
+            self._record(x)
+
+    def detach(self, *states: 'State'):
+        for x in states or list(self._history):
+            if self._history.pop(x, None) is not None:
+                self._bus.unsubscribe(x, CHANGED, self._on_change)
+
+    def _on_change(self, state: 'State', event, _from):
+        self._record(state)
+
+    def _record(self, state: 'State'):
+        try:
+            value = float(state.value)
+        except (TypeError, ValueError):
+            logger.debug(f'{state.name} value {state.value!r} is not numeric, not recorded')
+            return
+        self._history[state].add(self.clock(), value)
+
+    def history(self, state: 'State') -> StateHistory:
+        return self._history[state]
+
+    def samples(self, state: 'State', window: _Window = None) -> typing.List[typing.Tuple[float, float]]:
+        since = -math.inf if window is None else self.clock() - _seconds(window)
+        return self._history[state].samples(since)
+
+    def aggregate(self, state: 'State', window: _Window, how: str = MEAN) -> typing.Optional[float]:
+        """
+        Aggregate of values over last window, the mean is weighted by how long each value held
+        :param state:
+        :param window: timedelta or seconds
+        :param how: MEAN, MIN, MAX or COUNT
+        :return: aggregate or None if there were no values
+        """
+        now = self.clock()
+        return self._history[state].aggregate(now - _seconds(window), now, how)
+
+    def mean(self, state: 'State', window: _Window) -> typing.Optional[float]:
+        return self.aggregate(state, window, MEAN)
+
+    def min(self, state: 'State', window: _Window) -> typing.Optional[float]:
+        return self.aggregate(state, window, MIN)
+
+    def max(self, state: 'State', window: _Window) -> typing.Optional[float]:
+        return self.aggregate(state, window, MAX)
+
+
+def _seconds(window: _Window) -> float:
+    return window.total_seconds() if isinstance(window, timedelta) else window
@@ -0,0 +1,229 @@
+import asyncio
+import os
+import typing
+from array import array
+from bisect import bisect_left
+
+from .const import logger, Logger
+
+logger: Logger = logger.getChild('metrics')
+
+# seconds
+DEF_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def _format_labels(names: typing.Sequence[str], values: typing.Sequence[str], extra: str = '') -> str:
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+
+def _format_value(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+
+class Metric(object):
+    """
+    Base of metrics. Metric with labelnames is a family: values are kept by children, got with labels(*values)
+    """
+    kind = 'untyped'
+
+    def __init__(self, name: str, help: str = '', labelnames: typing.Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._children: typing.Dict[tuple, 'Metric'] = {}
+
+    def labels(self, *values) -> 'Metric':
+        assert len(values) == len(self.labelnames), f'{self.name} needs labels {self.labelnames}'
+        child = self._children.get(values)
+        if child is None:
+            child = self._children[values] = self._child()
+        return child
+
+    def _child(self) -> 'Metric':
+        raise NotImplementedError
+
+    def _samples(self, labels: tuple) -> typing.Iterator[str]:
+        raise NotImplementedError
+
+    def render(self) -> typing.Iterator[str]:
+        if self.help:
+            yield f'# HELP {self.name} {self.help}'
+        yield f'# TYPE {self.name} {self.kind}'
+        if self.labelnames:
+            for values, child in self._children.items():
+                yield from child._samples(values)
+        else:
+            yield from self._samples(())
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def __init__(self, name: str, help: str = '', labelnames: typing.Sequence[str] = ()):
+        super().__init__(name, help, labelnames)
+        self.value = 0
+
+    def _child(self):
+        return Counter(self.name, labelnames=self.labelnames)
+
+    def inc(self, amount: float = 1):
+        self.value += amount
+
+    def _samples(self, labels: tuple):
+        yield f'{self.name}{_format_labels(self.labelnames, labels)} {_format_value(self.value)}'
+
+
+class Gauge(Counter):
+    kind = 'gauge'
+
+    def _child(self):
+        return Gauge(self.name, labelnames=self.labelnames)
+
+    def set(self, value: float):
+        self.value = value
+
+    def dec(self, amount: float = 1):
+        self.value -= amount
+
+
+class Histogram(Metric):
+    """
+    Histogram with fixed buckets, counts are kept in preallocated array, observe is a bisect and two additions
+    """
+    kind = 'histogram'
+
+    def __init__(self, name: str, help: str = '', labelnames: typing.Sequence[str] = ()
+                 , buckets: typing.Sequence[float] = DEF_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # the last one is +Inf
+        self.counts = array('L', [0]) * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def _child(self):
+        return Histogram(self.name, labelnames=self.labelnames, buckets=self.buckets)
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def _samples(self, labels: tuple):
+        total = 0
+        for bound, cnt in zip(self.buckets + (float('inf'), ), self.counts):
+            total += cnt
+            le = _format_labels(self.labelnames, labels, f'le="{_format_value(float(bound))}"')
+            yield f'{self.name}_bucket{le} {total}'
+        labels = _format_labels(self.labelnames, labels)
+        yield f'{self.name}_sum{labels} {_format_value(self.sum)}'
+        yield f'{self.name}_count{labels} {self.count}'
+
+
+class Registry(object):
+    """
+    Keeps metrics and renders them in Prometheus text format.
+    Metrics are collected only while registry is enabled, instrumented code checks it before touching metrics:
+
+    ```
+    if registry.enabled:
+        STATE_CHANGES.inc()
+    ```
+    so disabled metrics cost one attribute check
+    """
+
+    def __init__(self, enabled: bool = False):
+        self.enabled = enabled
+        self._metrics: typing.Dict[str, Metric] = {}
+
+    def register(self, metric: Metric) -> Metric:
+        existing = self._metrics.get(metric.name)
+        if existing is not None:
+            assert type(existing) is type(metric), f'{metric.name} is already registered as {existing.kind}'
+            return existing
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, help: str = '', labelnames: typing.Sequence[str] = ()) -> Counter:
+        return self.register(Counter(name, help, labelnames))
+
+    def gauge(self, name: str, help: str = '', labelnames: typing.Sequence[str] = ()) -> Gauge:
+        return self.register(Gauge(name, help, labelnames))
+
+    def histogram(self, name: str, help: str = '', labelnames: typing.Sequence[str] = ()
+                  , buckets: typing.Sequence[float] = DEF_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, help, labelnames, buckets))
+
+    def get(self, name: str) -> typing.Optional[Metric]:
+        return self._metrics.get(name)
+
+    def render(self) -> str:
+        lines = []
+        for x in self._metrics.values():
+            lines.extend(x.render())
+        return '\n'.join(lines) + '\n'
+
+    def dump(self, path: str):
+        """
+        Write metrics to file, file is replaced atomically, so that it can be read by node_exporter textfile collector
+        """
+        tmp = f'{path}.tmp'
+        with open(tmp, 'w') as f:
+            f.write(self.render())
+        os.replace(tmp, path)
+
+    async def serve(self, port: int, host: str = '127.0.0.1', path: str = '/metrics') -> asyncio.AbstractServer:
+        """
+        Serve metrics over HTTP
+        :param port: there is no default, common exporter ports (eg 9100 of node_exporter) are likely to be taken
+        :return: server, close it to stop serving
+        """
+
+        async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+            try:
+                request = await reader.readline()
+                while (await reader.readline()).strip():
+                    pass
+                parts = request.decode('latin-1').split()
+                if len(parts) >= 2 and parts[0] == 'GET' and parts[1].split('?')[0] == path:
+                    status, content_type, body = '200 OK', CONTENT_TYPE, self.render().encode()
+                else:
+                    status, content_type, body = '404 Not Found', 'text/plain', b'not found\n'
+                writer.write(
+                    f'HTTP/1.1 {status}\r\nContent-Type: {content_type}\r\nContent-Length: {len(body)}\r\n'
+                    f'Connection: close\r\n\r\n'.encode() + body)
+                await writer.drain()
+            except Exception as err:
+                logger.warning(f'metrics request failed: {err}')
+            finally:
+                writer.close()
+
+        server = await asyncio.start_server(handle, host, port)
+        logger.info(f'metrics are served at http://{host}:{port}{path}')
+        return server
+
+
+registry = Registry()
+
+STATE_CHANGES = registry.counter('smarthome_state_changes_total', 'Changes of states values')
+BINDING_TRIGGERS = registry.counter(
+    'smarthome_binding_triggers_total', 'Values received by bindings', ['binding'])
+BINDING_PUSHES = registry.counter('smarthome_binding_pushes_total', 'Values pushed to bindings', ['binding'])
+MQTT_RECEIVED = registry.counter('smarthome_mqtt_received_total', 'MQTT messages received')
+MQTT_HANDLE_SECONDS = registry.histogram('smarthome_mqtt_handle_seconds', 'Time spent handling MQTT message')
+MQTT_OUT_QUEUE = registry.gauge('smarthome_mqtt_out_queue', 'MQTT messages waiting to be published', ['binding'])
+RULE_RUNS = registry.counter('smarthome_rule_runs_total', 'Rules executed', ['rule'])
+RULE_ERRORS = registry.counter('smarthome_rule_errors_total', 'Rules failed', ['rule'])
+RULE_SECONDS = registry.histogram('smarthome_rule_seconds', 'Time spent executing rules', ['rule'])
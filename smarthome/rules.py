@@ -5,6 +5,8 @@ import typing
 from .utils.utils import TimeTracker, CustomTime
 from asyncio_primitives import utils as async_utils, CustomCondition
 from .state import State
+from . import events
+from .events import Event
 from functools import wraps
 
 _LOOPS = []
@@ -25,37 +27,54 @@ def make_onetime_rule(cond: typing.Awaitable):
     return deco
 
 
-def rule(state: typing.Union[State, TimeTracker, Callable, Awaitable]):
+def _conditions_rule(conditions: typing.Iterable):
+    conditions = list(conditions)
+    if all(isinstance(x, Event) for x in conditions):
+        return events.rule(*conditions)
+    for x in conditions:
+        assert isinstance(x, CustomCondition)
+    return async_utils.rule(*conditions)
+
+
+def rule(state: typing.Union[State, TimeTracker, Callable, Awaitable], **kwargs):
     """
     Make rule from several input types:
 
-        - State or TimeTracker: call state.rule()
+        - State or TimeTracker: call state.rule(**kwargs), see State.rule for edge-triggered rules
+        - Event or iterable of Events (like State.changed): subscribe to events on events.bus
         - Callable: call state first, then make Condition-rule if it returns conditions or one-time rule if it returns awaitabler
         - Awaitable: one-time rule, waits for awaitable to finish and return.
+    Keyword arguments (edge, hysteresis, hold) are passed to State.rule, other inputs have no condition to apply
+    them to, so TypeError is raised instead of ignoring them
     :param state:
     :return:
     """
 
     if isinstance(state, (State, TimeTracker)):
-        return state.rule()
+        return state.rule(**kwargs)
+
+    if kwargs:
+        raise TypeError(f'{", ".join(kwargs)} can only be used with State rules, got {state!r}')
+
+    if isinstance(state, Event):
+        return events.rule(state)
 
     if isinstance(state, CustomCondition):
         return async_utils.rule(state)
 
     if isinstance(state, typing.Iterable):
-            for x in state:
-                assert isinstance(x, CustomCondition)
-            return async_utils.rule(*state)
+            return _conditions_rule(state)
 
     if isinstance(state, Callable):
         cond = state()
-        if isinstance(cond, CustomCondition):
+        if isinstance(cond, Event):
+            return events.rule(cond)
+
+        elif isinstance(cond, CustomCondition):
             return async_utils.rule(cond)
 
         elif isinstance(cond, typing.Iterable):
-            for x in cond:
-                assert isinstance(x, CustomCondition)
-            return async_utils.rule(*cond)
+            return _conditions_rule(cond)
 
         elif isinstance(cond, typing.Awaitable):
             return make_onetime_rule(cond)
@@ -64,7 +83,6 @@ def rule(state: typing.Union[State, TimeTracker, Callable, Awaitable]):
         return make_onetime_rule(state)
 
 
-
 def counter(max_count = None, max_wait=None):
     """
     Decorator. When foo is called, passes counter as a first argument
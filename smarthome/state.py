@@ -1,147 +1,233 @@
 import asyncio
-from dataclasses import dataclass, field
 from typing import Generic, Callable, Union
 
 from .const import _T, logger, _ThingT, Logger
 
 import typing
-from asyncio_primitives import CustomCondition, utils as async_utils
 from .utils.proxy import LambdaProxy
+from .utils.converters import from_bytes
+from . import events, expression
+from .computed import invalidate
+from .metrics import registry as metrics, STATE_CHANGES
+from .events import bus, CHANGED, RECEIVED_UPDATE, RECEIVED_COMMAND
 
 logger = logger.getChild('states')
 
-@dataclass(eq=False)
+def _always_true():
+    return True
+
+
 class State(Generic[_T]):
     """
     Represents one of Thing's state, when called change, command or update,
     then Events are triggered accordingly, notifying all the subscribers
 
+    State is slotted: it has no per-instance __dict__, default check and _str are shared by all the instances and
+    subscribers are kept in events.bus, so nothing is allocated for events until the first subscription
+
     :var check: callable, passed to rule-creator
+    :var changed, received_update, received_command: events of the state, subscribers are kept in events.bus
+    :var raw: last raw payload (bytes) the value was converted from, if the same payload comes again, it is not
+        converted, None if value was set otherwise
+    :var value: setting it invalidates computed states depending on this one and drops raw
 
     """
-    converter: Callable[[str], _T] = field(default_factory=float)
-    value: _T = 0
-    thing: Union[_ThingT] = field(default=None, init=False, repr=True)
-    name: str = field(default=None, init=False, repr=True)
-    changed: typing.List[CustomCondition] = field(default_factory=lambda : [CustomCondition()], init=False, repr=False)
-    received_update: typing.List[CustomCondition] = field(default_factory=lambda : [CustomCondition()], init=False, repr=False)
-    received_command: typing.List[CustomCondition] = field(default_factory=lambda : [CustomCondition()], init=False, repr=False)
-    check: typing.Callable = field(default_factory=lambda :lambda :True)
-    _str: str = 'state'
+    __slots__ = ('converter', '_value', 'thing', 'name', 'check', '_str', 'raw', '_dependents', '__weakref__')
+
+    def __init__(self
+                 , converter: Callable[[str], _T] = float
+                 , value: _T = 0
+                 , check: typing.Callable = None
+                 , _str: str = 'state'
+                 ):
+        self.converter = converter
+        # cells of computed states, that depend on this one
+        self._dependents: typing.Sequence = ()
+        self._value = value
+        self.thing: Union[_ThingT] = None
+        self.name: str = None
+        self.check = check or _always_true
+        self._str = _str
+        self.raw: bytes = None
+
+    __hash__ = object.__hash__
+
+    @property
+    def value(self) -> _T:
+        return self._value
+
+    @value.setter
+    def value(self, value: _T):
+        self._value = value
+        self.raw = None
+        if self._dependents:
+            invalidate(self._dependents)
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}(converter={self.converter!r}, value={self.value!r}, ' \
+               f'thing={self.thing!r}, name={self.name!r}, _str={self._str!r})'
+
+    @property
+    def root(self) -> 'State':
+        """
+        State itself, for proxies: wrapped state
+        """
+        return self
+
+    @property
+    def sources(self) -> typing.Tuple['State', ...]:
+        """
+        States, that proxy value or check depends on
+        """
+        return self,
+
+    @property
+    def value_node(self) -> expression.Node:
+        return expression.Ref(self)
+
+    @property
+    def check_node(self) -> expression.Node:
+        if self.check is _always_true:
+            return expression.Const(True)
+        return expression.Call(self.check)
+
+    @property
+    def changed(self) -> typing.Tuple[events.Event, ...]:
+        return events.Event(self, CHANGED),
+
+    @property
+    def received_update(self) -> typing.Tuple[events.Event, ...]:
+        return events.Event(self, RECEIVED_UPDATE),
 
+    @property
+    def received_command(self) -> typing.Tuple[events.Event, ...]:
+        return events.Event(self, RECEIVED_COMMAND),
 
     async def change(self, value: _T, _from: object = None):
-        if isinstance(value, str):
+        raw = None
+        if isinstance(value, (bytes, bytearray)):
+            if value == self.raw:
+                return False
+            raw = bytes(value)
+            value = from_bytes(self.converter, raw)
+        elif isinstance(value, str):
             value = self.converter(value)
-        if self.value != value:
-            logger.debug(f'Change {self.name} from {self.value} to {value}')
+        if self._value != value:
+            logger.debug(f'Change {self.name} from {self._value} to {value}')
             self.value = value
-            await async_utils.notify_many(*self.changed)
+            self.raw = raw
+            if metrics.enabled:
+                STATE_CHANGES.inc()
+            await bus.publish(self, CHANGED, _from)
             return True
         else:
+            self.raw = raw
             return False
 
     async def command(self, value: _T, _from: object = None):
         logger.debug(f'Command recieved for {self.thing.unique_id}.{self.name}')
-        await self.change(value)
-        await async_utils.notify_many(*self.received_command)
+        await self.change(value, _from)
+        await bus.publish(self, RECEIVED_COMMAND, _from)
 
     async def update(self, value: _T, _from: object = None):
         logger.debug(f'Update recieved for {self.thing.unique_id}.{self.name}')
-        await self.change(value)
-        await async_utils.notify_many(*self.received_update)
+        await self.change(value, _from)
+        await bus.publish(self, RECEIVED_UPDATE, _from)
 
     async def notify_changed(self):
-        await async_utils.notify_many(*self.changed)
+        await bus.publish(self, CHANGED)
 
-    def rule(self):
-        return async_utils.rule(*self.changed, check=self.check)
+    def rule(self, edge: bool = False, hysteresis: float = None, hold: float = None):
+        """
+        Make rule, triggered by changes of the state, if state is a condition (eg "st1 > st2"), rule is triggered only
+        while it is True
+        :param edge: trigger rule only when condition turns True, not on every change while it is True
+        :param hysteresis: for edge-rules: once triggered, condition stays True until thresholds are passed by
+            hysteresis (only comparisons like "<=", ">" are affected)
+        :param hold: for edge-rules: condition must stay True for hold seconds before rule is triggered
+        :return:
+        """
+        if not (edge or hysteresis or hold):
+            return events.rule(*self.changed, check=self.check)
+        release = None
+        if hysteresis:
+            release = expression.relax(self.check_node, hysteresis).compile('release')
+        return events.rule(*self.changed, check=self.check, edge=True, release=release, hold=hold)
 
     def __add__(self, other):
-        if isinstance(other, State):
-            return self.make_proxy(str_template='{x} + {y}', value=lambda x: x + other.value, y=other)
-        else:
-            return self.make_proxy(str_template=f'{{x}} + {other}', value=lambda x: x + other)
+        return self.make_proxy(str_template='{x} + {y}', value=self._binop('+', other), y=other)
 
     def __sub__(self, other):
-        if isinstance(other, State):
-            return self.make_proxy(str_template='{x} - {y}', value=lambda x: x - other.value, y=other)
-        else:
-            return self.make_proxy(str_template=f'{{x}} - {other}', value=lambda x: x - other)
+        return self.make_proxy(str_template='{x} - {y}', value=self._binop('-', other), y=other)
 
     def __truediv__(self, other):
-        if isinstance(other, State):
-            return self.make_proxy(str_template='{x} / {y}', value=lambda x: x / other.value, y=other)
-        else:
-            return self.make_proxy(str_template=f'{{x}} / {other}', value=lambda x: x / other)
+        return self.make_proxy(str_template='{x} / {y}', value=self._binop('/', other), y=other)
 
     def __mul__(self, other):
-        if isinstance(other, State):
-            return self.make_proxy(str_template='{x} * {y}', value=lambda x: x * other.value, y=other)
-        else:
-            return self.make_proxy(str_template=f'{{x}} * {other}', value=lambda x: x * other)
+        return self.make_proxy(str_template='{x} * {y}', value=self._binop('*', other), y=other)
 
     def __eq__(self, other):
-        if isinstance(other, State):
-            return self.make_proxy(str_template='{x} = {y}', check=lambda: self.value == other.value, y=other)
-        else:
-            return self.make_proxy(str_template=f'{{x}} = {other}', check=lambda: self.value == other)
+        return self.make_proxy(str_template='{x} = {y}', check=self._binop('==', other), y=other)
 
     def __ne__(self, other):
-        if isinstance(other, State):
-            return self.make_proxy(str_template='{x} != {y}', check=lambda: self.value != other.value, y=other)
-        else:
-            return self.make_proxy(str_template=f'{{x}} != {other}', check=lambda: self.value != other)
+        return self.make_proxy(str_template='{x} != {y}', check=self._binop('!=', other), y=other)
 
     def __le__(self, other):
-        if isinstance(other, State):
-            return self.make_proxy(str_template='{x} <= {y}', check=lambda: self.value <= other.value, y=other)
-        else:
-            return self.make_proxy(str_template=f'{{x}} <= {other}', check=lambda: self.value <= other)
+        return self.make_proxy(str_template='{x} <= {y}', check=self._binop('<=', other), y=other)
 
     def __lt__(self, other):
-        if isinstance(other, State):
-            return self.make_proxy(str_template='{x} < {y}', check=lambda: self.value < other.value, y=other)
-        else:
-            return self.make_proxy(str_template=f'{{x}} < {other}', check=lambda: self.value < other)
+        return self.make_proxy(str_template='{x} < {y}', check=self._binop('<', other), y=other)
 
     def __ge__(self, other):
-        if isinstance(other, State):
-            return self.make_proxy(str_template='{x} >= {y}', check=lambda: self.value >= other.value, y=other)
-        else:
-            return self.make_proxy(str_template=f'{{x}} >= {other}', check=lambda: self.value >= other)
+        return self.make_proxy(str_template='{x} >= {y}', check=self._binop('>=', other), y=other)
 
     def __gt__(self, other):
-        if isinstance(other, State):
-            return self.make_proxy(str_template='{x} > {y}', check=lambda: self.value > other.value, y=other)
-        else:
-            return self.make_proxy(str_template=f'{{x}} > {other}', check=lambda: self.value > other)
+        return self.make_proxy(str_template='{x} > {y}', check=self._binop('>', other), y=other)
 
     def __and__(self, other):
+        return self.make_proxy(str_template='{x} and {y}', check=self._boolop('and', other), y=other)
+
+    def __or__(self, other):
+        return self.make_proxy(str_template='{x} or {y}', check=self._boolop('or', other), y=other)
+
+    def computed(self):
+        """
+        Make derived state, which value is cached and recomputed only after one of its sources is changed.
+        Computed states can be used in another expressions, then they are recomputed once per change, no matter how
+        many dependents read them
+        :return:
+        """
+        from .computed import graph, CellRef
+        node = self.value_node
+        cell = graph.add(node)
+        return self.make_proxy(str_template='{x}', value=CellRef(cell, node.sources))
+
+    def _binop(self, op: str, other) -> expression.Node:
         if isinstance(other, State):
-            return self.make_proxy(str_template='{x} and {y}', check=lambda: self.check() and other.check(), y=other)
+            return expression.BinOp(op, self.value_node, other.value_node)
         else:
-            return self.make_proxy(str_template=f'{{x}} and {other}', check=lambda: self.check() and other)
+            return expression.BinOp(op, self.value_node, expression.Const(other))
 
-    def __or__(self, other):
+    def _boolop(self, op: str, other) -> expression.Node:
         if isinstance(other, State):
-            return self.make_proxy(str_template='{x} or {y}', check=lambda: self.check() or other.check(), y=other)
+            return expression.BinOp(op, self.check_node, other.check_node)
         else:
-            return self.make_proxy(str_template=f'{{x}} or {other}', check=lambda: self.check() or other)
+            return expression.BinOp(op, self.check_node, expression.Const(other))
 
     def make_proxy(self
                    , str_template: str
-                   , value: typing.Union[typing.Callable[[_T], _T], _T] = None
+                   , value: expression.Node = None
                    , y = None
-                   , check = None
-                   , _and=True
+                   , check: expression.Node = None
                    ):
         """
-        Make proxy for State. Replace value with lambda, adds conditions from other if other is State
-        :param x:
-        :param value:
-        :param y:
-        :param check:
+        Make proxy for State. Replace value and check with functions compiled from expressions, adds events from
+        other if other is State.
+        Proxy always wraps the root state and carries over overrides of self, so proxies are never nested
+        :param str_template:
+        :param value: expression of the new value
+        :param y: other operand
+        :param check: expression of the new check
         :return:
         """
 
@@ -151,23 +237,31 @@ class State(Generic[_T]):
             _other_str = y
 
         new_str = f'({str_template.format(x=self._str, y=_other_str)})'
-        kwargs = {'_str': new_str}
+        kwargs = dict(self._kwargs) if isinstance(self, LambdaProxy) else {}
+        kwargs['_str'] = new_str
 
-        if check:
-            def new_check():
-                return check()
+        if check is not None:
+            new_check = check.compile('check')
             kwargs['check'] = lambda x: new_check
+            kwargs['check_node'] = check
             setattr(new_check, '_str', new_str)
 
         if value is not None:
-            kwargs['value'] = value
-
-        if isinstance(y, State):
-            kwargs.update(
-                changed=self.changed + [x for x in y.changed if x not in self.changed]
-                , received_update=self.received_update + [x for x in y.received_update if x not in self.received_update]
-                , received_command=self.received_command + [x for x in y.received_command if x not in self.received_command]
-            )
-
-        return typing.cast(self.__class__, LambdaProxy(self, **kwargs))
-
+            new_value = value.compile('value')
+            kwargs['value'] = lambda x: new_value()
+            kwargs['value_node'] = value
+
+        sources = expression.unique(
+            self.sources
+            , y.sources if isinstance(y, State) else ()
+            , value.sources if value is not None else ()
+            , check.sources if check is not None else ()
+        )
+        kwargs.update(
+            sources=sources
+            , changed=tuple(events.Event(x, CHANGED) for x in sources)
+            , received_update=tuple(events.Event(x, RECEIVED_UPDATE) for x in sources)
+            , received_command=tuple(events.Event(x, RECEIVED_COMMAND) for x in sources)
+        )
+
+        return typing.cast(self.__class__, LambdaProxy(self.root, **kwargs))
@@ -0,0 +1,205 @@
+import asyncio
+import json
+import sqlite3
+import time
+import typing
+from concurrent.futures.thread import ThreadPoolExecutor
+
+from asyncio_primitives import utils as autils
+
+from .const import logger, Logger
+from .events import bus, EventBus, CHANGED
+
+if typing.TYPE_CHECKING:
+    from .thing import Thing
+    from .state import State
+
+logger: Logger = logger.getChild('store')
+
+# seconds between flushes of write-behind buffer
+DEF_FLUSH_INTERVAL = 5
+# buffer is flushed earlier, when it holds that many changed states
+DEF_MAX_PENDING = 500
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS states (
+    thing_id TEXT NOT NULL,
+    state_name TEXT NOT NULL,
+    value TEXT,
+    updated REAL,
+    PRIMARY KEY (thing_id, state_name)
+)
+'''
+_UPSERT = 'INSERT OR REPLACE INTO states (thing_id, state_name, value, updated) VALUES (?, ?, ?, ?)'
+_SELECT = 'SELECT thing_id, state_name, value FROM states'
+
+
+class StateStore(object):
+    """
+    Keeps values of states in SQLite, so that they survive restart.
+    Changes are not written one by one: write-behind buffer keeps only the last value of every state, it is flushed in
+    one transaction every flush_interval seconds or when max_pending states are changed.
+    All the database work is done in a separate thread
+
+    ```
+    class MyApp(App):
+        store = StateStore('states.db')
+    ```
+    App restores things from store with one query on start, then attaches them to store
+    """
+
+    def __init__(self
+                 , path: str = 'states.db'
+                 , flush_interval: float = DEF_FLUSH_INTERVAL
+                 , max_pending: int = DEF_MAX_PENDING
+                 , _bus: EventBus = None
+                 ):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self._bus = _bus or bus
+        # database thread, it is started on the first use and stopped by close, so that store can be started again
+        self._executor: ThreadPoolExecutor = None
+        self._db: sqlite3.Connection = None
+        # (thing_id, state_name) -> value
+        self._pending: typing.Dict[typing.Tuple[str, str], typing.Any] = {}
+        self._full = asyncio.Event()
+        self._attached: typing.List['State'] = []
+        # counters
+        self.written = 0
+        self.flushes = 0
+        self.flush_latency = 0.0
+
+    def __str__(self):
+        return f'StateStore <{self.path}>'
+
+    @property
+    def pending(self) -> int:
+        return len(self._pending)
+
+    async def _run(self, foo, *args):
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=1)
+        return await asyncio.get_event_loop().run_in_executor(self._executor, foo, *args)
+
+    def _open(self):
+        if self._db is None:
+            self._db = sqlite3.connect(self.path, check_same_thread=False)
+            self._db.execute(_SCHEMA)
+            self._db.commit()
+        return self._db
+
+    def _write(self, rows: list):
+        db = self._open()
+        with db:
+            db.executemany(_UPSERT, rows)
+
+    def _read(self) -> list:
+        return self._open().execute(_SELECT).fetchall()
+
+    def _close(self):
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+    async def restore(self, things: typing.Iterable['Thing']) -> int:
+        """
+        Set values of things' states from the store with one query. Events are not fired, but computed states
+        depending on restored ones are invalidated and raw payloads are dropped, like on any value assignment
+        :return: number of restored states
+        """
+        rows = await self._run(self._read)
+        things = {x.unique_id: x for x in things}
+        cnt = 0
+        for thing_id, state_name, value in rows:
+            thing = things.get(thing_id)
+            if thing is None:
+                continue
+            state = thing.states.get(state_name)
+            if state is None:
+                continue
+            state.value = json.loads(value)
+            cnt += 1
+        logger.debug(f'{self} restored {cnt} states')
+        return cnt
+
+    def attach(self, *things: 'Thing'):
+        """
+        Save current values of things and every change of them
+        """
+        for thing in things:
+            for name, state in thing.states.items():
+                self._bus.subscribe(state, CHANGED, self._on_change)
+                self._attached.append(state)
+            self.snapshot(thing)
+
+    def detach(self):
+        for x in self._attached:
+            self._bus.unsubscribe(x, CHANGED, self._on_change)
+        self._attached.clear()
+
+    def snapshot(self, thing: 'Thing'):
+        """
+        Put all the states of thing to write-behind buffer
+        """
+        for name, value in thing.as_json().items():
+            self._put(thing.unique_id, name, value)
+
+    def _on_change(self, state: 'State', event, _from):
+        self._put(state.thing.unique_id, state.name, state.value)
+
+    def _put(self, thing_id: str, state_name: str, value):
+        self._pending[(thing_id, state_name)] = value
+        if len(self._pending) >= self.max_pending:
+            self._full.set()
+
+    async def flush(self):
+        """
+        Write everything from buffer in one transaction
+        """
+        self._full.clear()
+        if not self._pending:
+            return
+        pending, self._pending = self._pending, {}
+        now = time.time()
+        rows = [(thing_id, state_name, json.dumps(value, default=str), now)
+                for (thing_id, state_name), value in pending.items()]
+        started = time.perf_counter()
+        try:
+            await self._run(self._write, rows)
+        except Exception as err:
+            # put rows back, unless they were changed meanwhile
+            for key, value in pending.items():
+                self._pending.setdefault(key, value)
+            logger.exception(f'{self} could not write {len(rows)} states: {err}')
+            return
+        self.flush_latency = time.perf_counter() - started
+        self.written += len(rows)
+        self.flushes += 1
+
+    @autils.endless_loop
+    @autils.set_logger(logger)
+    async def _flush_loop(self):
+        try:
+            await asyncio.wait_for(self._full.wait(), self.flush_interval)
+        except asyncio.TimeoutError:
+            pass
+        await self.flush()
+
+    async def start(self) -> asyncio.Task:
+        """
+        Start flushing buffer in background
+        :return: task of flush loop
+        """
+        await self._run(self._open)
+        return await self._flush_loop()
+
+    async def close(self):
+        """
+        Write the rest of buffer, close database and stop its thread
+        """
+        self.detach()
+        await self.flush()
+        await self._run(self._close)
+        self._executor.shutdown()
+        self._executor = None
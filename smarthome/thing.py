@@ -45,8 +45,12 @@ class Thing(_MixRules):
         self.name = None
         self._app: App = None
         self._bindings: List[Binding] = []
+        # bindings, thing is bound to with bind_to
+        self.bound_to: List[Binding] = []
         self.states: Dict[str, State] = {}
         self.start_callbacks = []
+        # coalesced pushes, their pending calls are cancelled on stop
+        self._coalescers: List[utils.Coalescer] = []
 
         # add states
         for name, x in self.__class__.__dict__.items():
@@ -73,7 +77,7 @@ class Thing(_MixRules):
         return self
 
     @start_callback
-    def bind_to(self, binding, push=True, subscribe=True, event='change', *states, **data):
+    def bind_to(self, binding, push=True, subscribe=True, event='change', *states, coalesce: float = None, **data):
         """
         Bind thing to binding
         :param binding:
@@ -81,6 +85,8 @@ class Thing(_MixRules):
         :param subscribe: if True, will subscribe to bindig
         :param event: str, event that will trigger pushed, can be ['change', 'update', 'command']
         :param states: if supplied, will push/subscribe only to those states
+        :param coalesce: if supplied, pushes of each state are sent at most once per coalesce seconds, intermediate
+            values are dropped and only the latest one is pushed
         :return:
         """
         from .bindings import Binding
@@ -99,19 +105,34 @@ class Thing(_MixRules):
                 else:
                     _event = x.received_command
 
-                @self.rule(_event)
-                @autils.set_name(f'push {self.unique_id}.{n}->{binding}')
-                @autils.set_logger(logger.getChild(self.unique_id))
-                async def push():
-                    await binding.push(x, **data)
+                self._make_push(binding, n, x, _event, coalesce, data)
+
+            if binding not in self.bound_to:
+                self.bound_to.append(binding)
+                if self._app is not None:
+                    self._app.on_bind(self, binding)
 
             # subscribe
             if subscribe:
-                binding.subscriptions[(self.unique_id, n)] = x
-                binding.subscribe_data[(self.unique_id, n)] = data
+                binding.register(self, n, x, data)
         logger.debug(f'{self} binded to {binding}')
         return self
 
+    def _make_push(self, binding, name, state, event, coalesce: float, data: dict):
+
+        async def do_push():
+            await binding.push(state, **data)
+
+        if coalesce:
+            do_push = utils.Coalescer(do_push, coalesce)
+            self._coalescers.append(do_push)
+
+        @self.rule(event)
+        @autils.set_name(f'push {self.unique_id}.{name}->{binding}')
+        @autils.set_logger(logger.getChild(self.unique_id))
+        async def push():
+            await do_push()
+
     @classmethod
     def get_states(cls):
         from .state import State
@@ -139,10 +160,26 @@ class Thing(_MixRules):
         return f'{self.__class__.__name__}.{self.name} with State:  {self.as_json()}'
 
 
-    async def start(self):
-        for x in self.start_callbacks:
+    async def prepare(self):
+        """
+        Run callbacks, that were postponed until thing gets its name (eg bind_to)
+        :return:
+        """
+        callbacks, self.start_callbacks = self.start_callbacks, []
+        for x in callbacks:
             if asyncio.iscoroutinefunction(x):
                 await x()
             else:
                 x()
-        await super().start()
\ No newline at end of file
+
+    async def start_rules(self):
+        await super().start()
+
+    async def start(self):
+        await self.prepare()
+        await self.start_rules()
+
+    async def stop(self):
+        await super().stop()
+        if self._coalescers:
+            await asyncio.gather(*[x.stop() for x in self._coalescers])
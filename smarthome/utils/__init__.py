@@ -1,4 +1,9 @@
-from . import converters
-from .sun import Sun
-from .utils import dict_in, TimeTracker, CustomTime
-from .sun import Sun
+from .lazy import lazy_module
+from .utils import dict_in, TimeTracker, CustomTime, Coalescer
+from .workers import WorkerPool
+
+# heavy modules are imported on first use: converters need yaml, Sun needs astral
+lazy_module(globals(), {
+    'converters': ('.converters', None),
+    'Sun': ('.sun', 'Sun'),
+})
@@ -1,16 +1,55 @@
 import json
 
-import yaml
-
 from ..const import logger
 
 
+def bytes_native(impl):
+    """
+    Declare bytes-native implementation of converter, it is used when raw payload comes in bytes, so that payload is
+    not decoded
+    ```
+    @bytes_native(lambda x: x == b'1')
+    def one_to_bool(value: str) -> bool:
+        return value == '1'
+    ```
+    """
+    def deco(foo):
+        foo.from_bytes = impl
+        return foo
+    return deco
+
+
+def _str_to_bool_bytes(value: bytes) -> bool:
+    value = value.strip().lower()
+    return value == b'true' or value == b'on'
+
+
+@bytes_native(_str_to_bool_bytes)
 def str_to_bool(value: str) -> bool:
-    return value.lower().strip() == 'True' or \
+    return value.lower().strip() == 'true' or \
            value.lower().strip() == 'on'
 
 
+# builtins, that accept bytes themselves
+_BYTES_NATIVE = {
+    float: float,
+    int: int,
+    str: bytes.decode,
+}
+
+
+def from_bytes(converter, raw: bytes):
+    """
+    Convert raw payload with bytes-native implementation of converter, if there is no such, raw is decoded first
+    """
+    native = _BYTES_NATIVE.get(converter) or getattr(converter, 'from_bytes', None)
+    if native is not None:
+        return native(raw)
+    return converter(raw.decode())
+
+
 def parse_raw_json(raw: str):
+    import yaml
     try:
         return yaml.load(raw, Loader=yaml.FullLoader)
     except Exception as err:
@@ -19,4 +58,4 @@ def parse_raw_json(raw: str):
         return json.loads(raw)
     except Exception as err:
         logger.warning(f'could not parse {raw} using json: \n{err} \n')
-        return None
\ No newline at end of file
+        return None
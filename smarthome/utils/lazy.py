@@ -0,0 +1,39 @@
+import typing
+from importlib import import_module
+
+# name -> (module, attribute), relative modules are resolved against the package, attribute None means module itself
+LazyNames = typing.Dict[str, typing.Tuple[str, typing.Optional[str]]]
+
+
+def lazy_module(namespace: dict, names: LazyNames):
+    """
+    Make names of the module imported on first access (PEP 562 module __getattr__), imported value is cached in the
+    module, so only the first access is slow:
+
+    ```
+    lazy_module(globals(), {
+        'MqttBinding': ('.async_mqtt', 'MqttBinding'),
+    })
+    ```
+    :param namespace: globals() of the module
+    :param names:
+    :return:
+    """
+    package = namespace['__name__']
+
+    def __getattr__(name):
+        try:
+            module, attr = names[name]
+        except KeyError:
+            raise AttributeError(f'module {package} has no attribute {name}') from None
+        ret = import_module(module, package)
+        if attr is not None:
+            ret = getattr(ret, attr)
+        namespace[name] = ret
+        return ret
+
+    def __dir__():
+        return sorted(set(namespace) | set(names))
+
+    namespace['__getattr__'] = __getattr__
+    namespace['__dir__'] = __dir__
@@ -19,8 +19,8 @@ class _MixRules(object):
     async def stop(self):
         await cancel_tasks(*self._tasks)
 
-    def rule(self, state):
+    def rule(self, state, **kwargs):
 
         def deco(foo):
-            self._for_start.append(rule(state)(foo)())
+            self._for_start.append(rule(state, **kwargs)(foo)())
         return deco
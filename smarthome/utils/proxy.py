@@ -2,7 +2,75 @@ import typing
 from ..const import _T
 from functools import partial
 from inspect import signature, getsource
-import wrapt
+from types import FunctionType
+
+# kinds of proxy attributes
+_CONST = object()  # override constant or method already bound to the proxy
+_CALL = object()  # override, called with wrapped value
+_PASS = object()  # wrapped value as is
+_BIND = object()  # method of wrapped class, it is bound to the proxy
+_SLOW = object()  # not defined on wrapped class, resolved on every access
+
+# (wrapped class, item) -> kind
+_KINDS: typing.Dict[typing.Tuple[type, str], object] = {}
+
+
+def _class_kind(cls: type, item: str):
+    for klass in cls.__mro__:
+        if item in klass.__dict__:
+            attr = klass.__dict__[item]
+            break
+    else:
+        return _SLOW
+    if isinstance(attr, FunctionType):
+        try:
+            if 'self' in signature(attr).parameters:
+                return _BIND
+        except (TypeError, ValueError):
+            pass
+    return _PASS
+
+
+class _Overrides(dict):
+    """
+    Proxy kwargs, that drops proxy's resolution cache on every change
+    """
+
+    def __init__(self, kwargs: dict, on_change: typing.Callable[[], None]):
+        super().__init__(kwargs)
+        self._on_change = on_change
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self._on_change()
+
+    def __delitem__(self, key):
+        super().__delitem__(key)
+        self._on_change()
+
+    def update(self, *args, **kwargs):
+        super().update(*args, **kwargs)
+        self._on_change()
+
+    def setdefault(self, key, default=None):
+        ret = super().setdefault(key, default)
+        self._on_change()
+        return ret
+
+    def pop(self, *args):
+        ret = super().pop(*args)
+        self._on_change()
+        return ret
+
+    def popitem(self):
+        ret = super().popitem()
+        self._on_change()
+        return ret
+
+    def clear(self):
+        super().clear()
+        self._on_change()
+
 
 def proxy(wrapped: _T, **kwargs):
 
@@ -14,6 +82,8 @@ class LambdaProxy(typing.Generic[_T]):
     Object wrapper. Modificates objects arguments with lambda function or constant
     Pass argument modificators as kwargs on initialisation
     Note that properties now does not work as expected, they stay the same as in source object
+    The way every attribute is got (override, method bound to the proxy or wrapped value) is resolved once and
+    cached, so repeated access is a dict lookup. Changing _kwargs drops the cache
     Exs:
 
     ```
@@ -36,17 +106,61 @@ class LambdaProxy(typing.Generic[_T]):
     assert isinstance(mut, LambdaProxy)
     ```
     """
-    __not_wrapped__ = ['__repr__', '_kwargs', '_wrapt', '__getattribute__', 'show_lambdas']
+    __not_wrapped__ = ['__repr__', '_kwargs', '_wrapt', '_cache', '__getattribute__', '__setattr__', 'show_lambdas'
+        , '_resolve', '_getattr_uncached']
 
     def __init__(self, wrapped: _T, **kwargs):
         self._wrapt = wrapped
         self._kwargs = kwargs
-        pass
+
+    def __setattr__(self, key, value):
+        if key == '_kwargs':
+            cache = {}
+            object.__setattr__(self, '_cache', cache)
+            value = _Overrides(value, on_change=cache.clear)
+        object.__setattr__(self, key, value)
 
     def __getattribute__(self, item):
-        __not_wrapped__ = object.__getattribute__(self, '__not_wrapped__')
-        if item in __not_wrapped__:
+        if item in _NOT_WRAPPED:
             return object.__getattribute__(self, item)
+        cache: dict = object.__getattribute__(self, '_cache')
+        try:
+            kind, ret = cache[item]
+        except KeyError:
+            kind, ret = cache[item] = object.__getattribute__(self, '_resolve')(item)
+        if kind is _CONST:
+            return ret
+        elif kind is _PASS:
+            try:
+                return getattr(object.__getattribute__(self, '_wrapt'), item)
+            except AttributeError:
+                pass
+        elif kind is _CALL:
+            return ret(getattr(object.__getattribute__(self, '_wrapt'), item))
+        return object.__getattribute__(self, '_getattr_uncached')(item)
+
+    def _resolve(self, item) -> typing.Tuple[object, typing.Any]:
+        """
+        Find out once, how item should be got from the proxy
+        :return: kind of item and constant value for it: override value or method bound to the proxy
+        """
+        kwargs: dict = self._kwargs
+        if item in kwargs:
+            ret = kwargs[item]
+            return (_CALL if callable(ret) else _CONST), ret
+        cls = self._wrapt.__class__
+        key = (cls, item)
+        kind = _KINDS.get(key)
+        if kind is None:
+            kind = _KINDS[key] = _class_kind(cls, item)
+        if kind is _BIND:
+            return _CONST, partial(getattr(cls, item), self)
+        return kind, None
+
+    def _getattr_uncached(self, item):
+        """
+        Resolve item without cache, used for attributes, that are not defined on wrapped class
+        """
         kwargs: dict = self._kwargs
         obj: object = self._wrapt
         if item in kwargs:
@@ -65,11 +179,11 @@ class LambdaProxy(typing.Generic[_T]):
                         sig = signature(ret)
                         if 'self' in sig.parameters:
                             return partial(ret, self)
-                        ret = getattr(obj.__class__, item)
-                        sig = signature(ret)
+                        cls_ret = getattr(obj.__class__, item)
+                        sig = signature(cls_ret)
                         if 'self' in sig.parameters:
-                            return partial(ret, self)
-                    except AttributeError:
+                            return partial(cls_ret, self)
+                    except (AttributeError, TypeError, ValueError):
                         pass
                 return ret
             except AttributeError:
@@ -145,3 +259,6 @@ class LambdaProxy(typing.Generic[_T]):
     @property
     def __or__(self):
         return partial(self._wrapt.__class__.__or__, self)
+
+
+_NOT_WRAPPED = frozenset(LambdaProxy.__not_wrapped__)
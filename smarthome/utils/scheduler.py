@@ -0,0 +1,259 @@
+import asyncio
+import heapq
+import itertools
+import typing
+from datetime import datetime, timedelta
+
+from ..const import logger, Logger
+
+logger: Logger = logger.getChild('scheduler')
+
+_When = typing.Union[datetime, float]
+_Delay = typing.Union[timedelta, float]
+
+# when there are more cancelled timers in the heap, it is rebuilt
+COMPACT_THRESHOLD = 64
+
+
+def _seconds(delay: _Delay) -> float:
+    return delay.total_seconds() if isinstance(delay, timedelta) else delay
+
+
+class Timer(object):
+    """
+    Handle of scheduled callback, returned by Scheduler, use cancel to unschedule it
+    """
+    __slots__ = ('deadline', 'callback', 'args', 'interval', 'cancelled', 'scheduled', '_scheduler', '_tasks')
+
+    def __init__(self, scheduler: 'Scheduler', deadline: float, callback: typing.Callable, args: tuple
+                 , interval: float = None):
+        self._scheduler = scheduler
+        self.deadline = deadline
+        self.callback = callback
+        self.args = args
+        self.interval = interval
+        self.cancelled = False
+        self.scheduled = False
+        # tasks of coroutines, returned by callback, that are not finished yet
+        self._tasks: typing.Set[asyncio.Future] = None
+
+    def cancel(self):
+        """
+        Unschedule callback and cancel its tasks, that are still running
+        """
+        if not self.cancelled:
+            self.cancelled = True
+            if self.scheduled:
+                self._scheduler._on_cancel()
+        if self._tasks:
+            _cancel_tasks(self._tasks)
+
+    def __repr__(self):
+        return f'Timer <{self.callback} at {datetime.fromtimestamp(self.deadline)}>'
+
+
+class Scheduler(object):
+    """
+    One service for all the time-based rules. Pending deadlines are kept in a heap, only one loop timer handle is armed
+    for the nearest of them. When it fires, all due callbacks are dispatched in one batch.
+    Callbacks can be usual functions or coroutine functions, coroutines are started as tasks, that are kept till they
+    are finished and cancelled with their timer or with cancel_all.
+
+    Time is taken from clock (CustomTime.now by default), inject another clock and call run_due to fast-forward in
+    tests
+    """
+
+    def __init__(self, clock: typing.Callable[[], datetime] = None):
+        from .utils import CustomTime
+        self.clock = clock or CustomTime.now
+        self._heap: typing.List[typing.Tuple[float, int, Timer]] = []
+        self._seq = itertools.count()
+        self._cancelled = 0
+        self._handle: asyncio.TimerHandle = None
+        # loop, the handle belongs to
+        self._handle_loop: asyncio.AbstractEventLoop = None
+        self._armed_at: float = None
+        # tasks of coroutine callbacks, that are not finished yet
+        self._tasks: typing.Set[asyncio.Future] = set()
+
+    def time(self) -> float:
+        return self.clock().timestamp()
+
+    @property
+    def pending(self) -> int:
+        return len(self._heap) - self._cancelled
+
+    def call_at(self, when: _When, callback: typing.Callable, *args) -> Timer:
+        if isinstance(when, datetime):
+            when = when.timestamp()
+        return self._push(Timer(self, when, callback, args))
+
+    def call_later(self, delay: _Delay, callback: typing.Callable, *args) -> Timer:
+        return self.call_at(self.time() + _seconds(delay), callback, *args)
+
+    def repeat(self, interval: _Delay, callback: typing.Callable, *args, start: _When = None) -> Timer:
+        """
+        Call callback every interval at fixed rate: next deadline is counted from the previous one, not from the time
+        callback was called, so there is no drift. Missed deadlines are skipped
+        :param interval:
+        :param callback:
+        :param start: first deadline, by default now + interval
+        :return:
+        """
+        interval = _seconds(interval)
+        assert interval > 0, 'interval must be positive'
+        if start is None:
+            start = self.time() + interval
+        elif isinstance(start, datetime):
+            start = start.timestamp()
+        return self._push(Timer(self, start, callback, args, interval=interval))
+
+    async def sleep_until(self, when: _When):
+        fut = asyncio.get_running_loop().create_future()
+        timer = self.call_at(when, _set_done, fut)
+        try:
+            await fut
+        finally:
+            timer.cancel()
+
+    async def sleep(self, delay: _Delay):
+        await self.sleep_until(self.time() + _seconds(delay))
+
+    def run_due(self) -> int:
+        """
+        Dispatch all the callbacks, which deadline has come
+        :return: number of dispatched callbacks
+        """
+        now = self.time()
+        due = []
+        while self._heap and self._heap[0][0] <= now:
+            timer = heapq.heappop(self._heap)[2]
+            timer.scheduled = False
+            if timer.cancelled:
+                self._cancelled -= 1
+                continue
+            due.append(timer)
+        for timer in due:
+            if timer.interval:
+                timer.deadline += timer.interval
+                if timer.deadline <= now:
+                    timer.deadline += ((now - timer.deadline) // timer.interval + 1) * timer.interval
+                self._push(timer, arm=False)
+            self._call(timer)
+        self._arm()
+        return len(due)
+
+    def cancel_all(self):
+        """
+        Unschedule all the callbacks and cancel their running tasks
+        """
+        _cancel_tasks(self._tasks)
+        for _, _, timer in self._heap:
+            timer.cancelled = True
+            timer.scheduled = False
+        self._heap.clear()
+        self._cancelled = 0
+        self._arm()
+
+    def rearm(self):
+        """
+        Arm loop timer again, call it when event loop or clock is replaced
+        """
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+            self._handle_loop = None
+        self._armed_at = None
+        self._arm()
+
+    def _push(self, timer: Timer, arm=True) -> Timer:
+        timer.scheduled = True
+        heapq.heappush(self._heap, (timer.deadline, next(self._seq), timer))
+        if arm:
+            self._arm()
+        return timer
+
+    def _call(self, timer: Timer):
+        try:
+            ret = timer.callback(*timer.args)
+            if asyncio.iscoroutine(ret):
+                self._track(timer, asyncio.ensure_future(ret))
+        except Exception as err:
+            logger.exception(f'{timer} failed: {err}')
+
+    def _track(self, timer: Timer, task: asyncio.Future):
+        """
+        Keep task till it is finished: loop keeps only weak references to tasks
+        """
+        if timer._tasks is None:
+            timer._tasks = set()
+
+        def done(task: asyncio.Future):
+            self._tasks.discard(task)
+            timer._tasks.discard(task)
+
+        self._tasks.add(task)
+        timer._tasks.add(task)
+        task.add_done_callback(done)
+
+    def _on_cancel(self):
+        self._cancelled += 1
+        if self._cancelled > COMPACT_THRESHOLD and self._cancelled * 2 > len(self._heap):
+            self._heap = [x for x in self._heap if not x[2].cancelled]
+            heapq.heapify(self._heap)
+            self._cancelled = 0
+            self._arm()
+
+    def _arm(self):
+        """
+        Arm loop timer for the nearest deadline on the running loop (or the current one, if none is running yet).
+        Handle is armed again if it was made by another loop or cancelled, even if deadline is the same.
+        If there is no loop at all, nothing is armed till the next call
+        """
+        deadline = self._heap[0][0] if self._heap else None
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            try:
+                loop = asyncio.get_event_loop()
+            except RuntimeError:
+                loop = None
+                deadline = None
+        if deadline == self._armed_at and self._handle is not None and self._handle_loop is loop \
+                and not self._handle.cancelled():
+            return
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+            self._handle_loop = None
+        self._armed_at = deadline
+        if deadline is not None:
+            self._handle = loop.call_later(max(deadline - self.time(), 0), self._on_timer)
+            self._handle_loop = loop
+
+    def _on_timer(self):
+        self._handle = None
+        self._handle_loop = None
+        self._armed_at = None
+        self.run_due()
+
+
+def _cancel_tasks(tasks: typing.Iterable[asyncio.Future]):
+    """
+    Cancel tasks, except the current one (eg callback that cancels its own timer)
+    """
+    try:
+        current = asyncio.current_task()
+    except RuntimeError:
+        current = None
+    for x in list(tasks):
+        if x is not current:
+            x.cancel()
+
+
+def _set_done(fut: asyncio.Future):
+    if not fut.done():
+        fut.set_result(None)
+
+
+scheduler = Scheduler()
@@ -0,0 +1,108 @@
+import asyncio
+import typing
+from datetime import datetime, timedelta
+from selectors import BaseSelector
+
+from ..const import logger, Logger
+from .utils import CustomTime
+from .scheduler import scheduler
+
+logger: Logger = logger.getChild('simulation')
+
+Record = typing.Tuple[datetime, typing.Any, typing.Any]
+
+
+class _VirtualSelector(object):
+    """
+    Wraps loop's selector: instead of blocking until the nearest timer, polls for io and moves virtual time forward
+    """
+
+    def __init__(self, selector: BaseSelector, loop: 'VirtualEventLoop'):
+        self._selector = selector
+        self._loop = loop
+
+    def select(self, timeout=None):
+        if timeout is None or timeout <= 0:
+            return self._selector.select(timeout)
+        ready = self._selector.select(0)
+        if not ready:
+            self._loop.advance(timeout)
+        return ready
+
+    def __getattr__(self, item):
+        return getattr(self._selector, item)
+
+
+class VirtualEventLoop(asyncio.SelectorEventLoop):
+    """
+    Event loop with virtual time: when there is nothing to run, time jumps to the nearest scheduled callback instead of
+    waiting for it, so asyncio.sleep and all the timers finish instantly.
+    Use now as a clock for CustomTime, so that time-based rules follow virtual time
+    """
+
+    def __init__(self, start: datetime = None):
+        super().__init__()
+        self._selector = _VirtualSelector(self._selector, self)
+        self._virtual_time = 0.0
+        self.start = (start or datetime.now()).timestamp()
+
+    def time(self) -> float:
+        return self._virtual_time
+
+    def advance(self, seconds: float):
+        self._virtual_time += seconds
+
+    def now(self) -> CustomTime:
+        return CustomTime.fromtimestamp(self.start + self._virtual_time)
+
+
+def run(main: typing.Awaitable, start: datetime = None):
+    """
+    Run main in VirtualEventLoop, CustomTime.now() follows virtual time until main is finished.
+    Run App under simulation like:
+
+    ```
+    async def main():
+        app = await App.from_module('test', conf)
+        await app.start()
+        await replay(records)
+        await app.stop()
+
+    run(main(), start=datetime(2020, 1, 1))
+    ```
+    :param main: coroutine
+    :param start: virtual time at the start, now by default
+    :return: result of main
+    """
+    loop = VirtualEventLoop(start)
+    try:
+        old_loop = asyncio.get_event_loop_policy().get_event_loop()
+    except RuntimeError:
+        # current loop was cleared, eg by asyncio.run
+        old_loop = None
+    asyncio.set_event_loop(loop)
+    CustomTime.set_clock(loop.now)
+    scheduler.rearm()
+    try:
+        return loop.run_until_complete(main)
+    finally:
+        CustomTime.set_clock(None)
+        loop.close()
+        asyncio.set_event_loop(old_loop if old_loop is not None and not old_loop.is_closed() else None)
+        scheduler.rearm()
+
+
+async def replay(records: typing.Iterable[Record], command=False, _from='replay'):
+    """
+    Feed recorded values to states at their original time
+    :param records: (time, state, value) sorted by time
+    :param command: if True, values are passed as commands, else as updates
+    :return:
+    """
+    for when, state, value in records:
+        if when > CustomTime.now():
+            await scheduler.sleep_until(when)
+        if command:
+            await state.command(value, _from=_from)
+        else:
+            await state.update(value, _from=_from)
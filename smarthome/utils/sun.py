@@ -1,16 +1,127 @@
-from datetime import datetime, timedelta
+from array import array
+from bisect import bisect_right
+from datetime import datetime, timedelta, date as _date, time as _time
 from functools import partial
-from typing import Callable, Optional, Generic
-from ..const import _T, _X
+from typing import Callable, Optional, Generic, Dict
+from ..const import _T, _X, logger
 
 import attr
-from astral import Astral
+from astral import Astral, AstralError
 
 from .utils import TimeTracker, CustomTime
 from functools import wraps
 from asyncio_primitives import utils as autils
 import asyncio
 
+logger = logger.getChild('sun')
+
+SUN_EVENTS = ('dawn', 'sunrise', 'sunset', 'dusk')
+
+# how many days are precomputed at once
+DEF_CALENDAR_DAYS = 366
+
+
+class SunCalendar:
+    """
+    Precomputed timestamps of sun events for one location. Every event is kept in a sorted array, the next event is
+    found with binary search. Calendar covers continuous range of dates: when a query is out of it, the range is
+    extended by DEF_CALENDAR_DAYS to the side of the query, so queries of the past (eg simulation) and of now do not
+    recompute each other's days. Range is computed anew only if the query is further than DEF_CALENDAR_DAYS from it
+    """
+
+    def __init__(self, loc, days: int = DEF_CALENDAR_DAYS):
+        self.loc = loc
+        self.days = days
+        self._times: Dict[str, array] = {x: array('d') for x in SUN_EVENTS}
+        # covered range: [_first_date, _next_date)
+        self._first_date: _date = None
+        self._next_date: _date = None
+
+    def _compute(self, start: _date) -> Dict[str, array]:
+        times = {x: array('d') for x in SUN_EVENTS}
+        for i in range(self.days):
+            date = start + timedelta(days=i)
+            try:
+                events = self.loc.sun(date)
+            except AstralError:
+                # polar day or night, some of events may still happen
+                events = {}
+                for name in SUN_EVENTS:
+                    try:
+                        events[name] = getattr(self.loc, name)(date)
+                    except AstralError:
+                        pass
+            for name in SUN_EVENTS:
+                if name in events:
+                    times[name].append(events[name].timestamp())
+        logger.debug(f'{self.loc.name} sun calendar is computed from {start} to {start + timedelta(days=self.days)}')
+        return times
+
+    def _fill(self, start: _date):
+        self._times = self._compute(start)
+        self._first_date = start
+        self._next_date = start + timedelta(days=self.days)
+
+    def _extend_back(self, start: _date):
+        """
+        Make calendar start not later than start
+        """
+        chunk = timedelta(days=self.days)
+        if start < self._first_date - chunk:
+            return self._fill(start)
+        start = self._first_date - chunk
+        times = self._compute(start)
+        for name, x in times.items():
+            x.extend(self._times[name])
+        self._times = times
+        self._first_date = start
+
+    def _extend_forward(self, day: _date):
+        """
+        Make calendar cover the day after day
+        """
+        chunk = timedelta(days=self.days)
+        if day + timedelta(days=1) >= self._next_date + chunk:
+            return self._fill(day - timedelta(days=1))
+        for name, x in self._compute(self._next_date).items():
+            self._times[name].extend(x)
+        self._next_date += chunk
+
+    def next_time(self, name: str, after: float) -> Optional[float]:
+        """
+        :param name: one of SUN_EVENTS
+        :param after: timestamp
+        :return: timestamp of the first event strictly after "after", None if there is no such event for a year
+        """
+        day = datetime.fromtimestamp(after).date()
+        if self._first_date is None:
+            self._fill(day - timedelta(days=1))
+        elif day <= self._first_date:
+            self._extend_back(day - timedelta(days=1))
+        for _ in range(2):
+            times = self._times[name]
+            i = bisect_right(times, after)
+            if i < len(times):
+                return times[i]
+            self._extend_forward(day)
+
+
+_astral: Astral = None
+_calendars: Dict[str, SunCalendar] = {}
+
+
+def get_calendar(city_name: str) -> SunCalendar:
+    """
+    Sun calendars are shared by all Sun objects of the same city
+    """
+    global _astral
+    calendar = _calendars.get(city_name)
+    if calendar is None:
+        if _astral is None:
+            _astral = Astral()
+        calendar = _calendars[city_name] = SunCalendar(_astral.geocoder[city_name])
+    return calendar
+
 
 @attr.s
 class Sun:
@@ -18,26 +129,39 @@ class Sun:
     city_name: str = attr.ib()
 
     def __attrs_post_init__(self):
-        self.loc = Astral().geocoder[self.city_name]
+        self.calendar = get_calendar(self.city_name)
+        self.loc = self.calendar.loc
 
     def get_time(self, name, date=None, offset:timedelta = timedelta(seconds=0))->TimeTracker:
-        date = date or CustomTime.now().date()
-        next_time = self.loc.sun(date)[name] + offset
-        while next_time <= CustomTime.now():
-            date = date + timedelta(days=1) + offset
-            next_time = self.loc.sun(date)[name]
-        return TimeTracker(next_time)
+        after = CustomTime.now().timestamp()
+        if date is not None:
+            after = max(after, datetime.combine(date, _time()).timestamp())
+        shift = offset.total_seconds()
+        next_time = self.calendar.next_time(name, after - shift)
+        if next_time is None:
+            raise RuntimeError(f'there is no {name} in {self.city_name} for a year')
+        return TimeTracker(CustomTime.fromtimestamp(next_time + shift))
 
     def rule(self, name, offset:timedelta = timedelta(seconds=0)):
         assert name in ['sunrise', 'dusk', 'sunset', 'dawn']
         def deco(foo):
             @wraps(foo)
-            async def wrapper(*args, **kwargs) -> asyncio.Task:
-                @autils.endless_loop
-                async def _loop():
-                    await self.get_time(name, offset=offset).wait()
+            @autils.mark_starter
+            async def wrapper(*args, **kwargs) -> asyncio.Future:
+                from .scheduler import scheduler
+                from ..events import Subscription
+                timer = None
+
+                def schedule():
+                    nonlocal timer
+                    timer = scheduler.call_at(self.get_time(name, offset=offset).time, fire)
+
+                async def fire():
+                    schedule()
                     await autils.async_run(foo, *args, **kwargs)
-                return await _loop()
+
+                schedule()
+                return Subscription(lambda: timer.cancel())
             return wrapper
         return deco
 
@@ -3,7 +3,7 @@ from datetime import datetime, timedelta
 from typing import Dict, Generator, Tuple
 import typing
 import warnings
-from functools import wraps
+from functools import wraps, partial
 
 import attr
 from inspect import signature, Parameter
@@ -31,7 +31,24 @@ def dict_in(dct: Dict[_X, _T], *_in: _X) -> Generator[Tuple[_X, _T], None, None]
 
 
 class CustomTime(datetime):
-    pass
+    """
+    Use CustomTime.now() instead of datetime.now() in time-based code, so that it follows the clock set with
+    set_clock (eg virtual clock of simulation)
+    """
+    _clock: typing.Callable[[], datetime] = None
+
+    @classmethod
+    def now(cls, tz=None):
+        if cls._clock is not None:
+            return cls._clock()
+        return super().now(tz)
+
+    @classmethod
+    def set_clock(cls, clock: typing.Optional[typing.Callable[[], datetime]]):
+        """
+        :param clock: callable returning current time, None to return to the system clock
+        """
+        CustomTime._clock = clock
 
 
 @attr.s
@@ -44,9 +61,9 @@ class TimeTracker:
         return cls(CustomTime.now())
 
     async def wait(self):
-        sleep = (self.time - CustomTime.now()).total_seconds()
-        if sleep > 0:
-            await asyncio.sleep(sleep)
+        from .scheduler import scheduler
+        if self.time > CustomTime.now():
+            await scheduler.sleep_until(self.time)
 
     def rule(self):
         """
@@ -57,11 +74,19 @@ class TimeTracker:
             @wraps(foo)
             @autils.mark_starter
             async def wrapper(*args, **kwargs):
-                async def rule(started):
-                    await started
-                    await self.wait()
-                    await autils.async_run(foo, *args, **kwargs)
-                return await autils.wait_started(rule)
+                from .scheduler import scheduler
+                from ..events import Subscription
+
+                async def run():
+                    try:
+                        await autils.async_run(foo, *args, **kwargs)
+                    finally:
+                        if not ret.done():
+                            ret.set_result(None)
+
+                timer = scheduler.call_at(self.time, run)
+                ret = Subscription(timer.cancel)
+                return ret
             return wrapper
         return deco
 
@@ -73,15 +98,13 @@ class TimeTracker:
             @wraps(foo)
             @autils.mark_starter
             async def wrapper(*args, **kwargs):
-                @autils.endless_loop
-                async def _loop():
-                    await (cls.now() + time_interval).wait()
-                    await autils.async_run(foo, *args, **kwargs)
-                return await _loop()
+                from .scheduler import scheduler
+                from ..events import Subscription
+                timer = scheduler.repeat(time_interval, partial(autils.async_run, foo, *args, **kwargs))
+                return Subscription(timer.cancel)
             return wrapper
         return deco
 
-
     def __add__(self, other):
         if isinstance(other, (int, float)):
             other = timedelta(minutes=other)
@@ -97,6 +120,55 @@ class TimeTracker:
         return TimeTracker(self.time - other)
 
 
+# running tasks of all the coalescers
+_coalescing: typing.Set[asyncio.Future] = set()
+
+
+class Coalescer:
+    """
+    Wraps async foo without arguments. First call runs foo at once, calls made while foo is running or during
+    window seconds after it are collapsed into one more call made when the window ends. So foo runs at most once
+    per window, and the last call is never lost
+    """
+
+    def __init__(self, foo: typing.Callable[[], typing.Awaitable], window: float):
+        self.foo = foo
+        self.window = window
+        self._pending = False
+        self._task: asyncio.Task = None
+
+    async def __call__(self):
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._run())
+            # coalescer may be dropped without stop, the task is kept till it is finished anyway
+            _coalescing.add(self._task)
+            self._task.add_done_callback(_coalescing.discard)
+        else:
+            self._pending = True
+
+    async def _run(self):
+        try:
+            while True:
+                self._pending = False
+                try:
+                    await self.foo()
+                except Exception as err:
+                    logger.exception(f'{self.foo} failed: {err}')
+                await asyncio.sleep(self.window)
+                if not self._pending:
+                    break
+        finally:
+            self._task = None
+
+    async def stop(self):
+        """
+        Cancel running call and pending one
+        """
+        self._pending = False
+        if self._task is not None:
+            await cancel(self._task)
+
+
 async def cancel(task: asyncio.Task):
     if not (task.done() or task.cancelled()):
         try:
@@ -0,0 +1,157 @@
+import asyncio
+import time
+import typing
+from collections import OrderedDict
+
+from asyncio_primitives import utils as autils
+
+from ..const import logger, Logger
+
+logger: Logger = logger.getChild('workers')
+
+# overflow policies
+BLOCK = 'block'  # put waits until worker has free space
+DROP_OLDEST = 'drop_oldest'  # the oldest item of worker's backlog is dropped
+COALESCE = 'coalesce'  # item replaces pending item with the same coalesce key, if there is no such item, put waits
+
+DEF_WORKERS = 4
+DEF_BACKLOG = 1000
+
+
+class _Worker(object):
+    __slots__ = ('backlog', 'ready', 'not_full', '_seq')
+
+    def __init__(self):
+        # coalesce key -> (item, enqueued at)
+        self.backlog: typing.OrderedDict[typing.Hashable, typing.Tuple[typing.Any, float]] = OrderedDict()
+        self.ready = asyncio.Event()
+        self.not_full = asyncio.Event()
+        self.not_full.set()
+        self._seq = 0
+
+    def next_key(self):
+        self._seq += 1
+        return self._seq
+
+
+class WorkerPool(object):
+    """
+    Items are handled by a fixed number of worker coroutines. Items with the same key always go to the same worker, so
+    they are handled in the order they were put. Every worker has a bounded backlog, when it is full, overflow policy
+    is applied: BLOCK, DROP_OLDEST or COALESCE
+
+    ```
+    pool = WorkerPool(handle, workers=4, overflow=COALESCE)
+    tasks = await pool.start()
+    await pool.put(thing_id, msg, coalesce=msg.topic)
+    ```
+    """
+
+    def __init__(self
+                 , handler: typing.Callable[[typing.Any], typing.Awaitable]
+                 , workers: int = DEF_WORKERS
+                 , backlog: int = DEF_BACKLOG
+                 , overflow: str = BLOCK
+                 , name: str = 'pool'
+                 ):
+        """
+        :param handler: coroutine function, called with every item
+        :param workers: number of workers
+        :param backlog: max number of pending items per worker
+        :param overflow: policy applied to full backlog
+        :param name: used in logs
+        """
+        assert workers >= 1, 'workers must be positive'
+        assert overflow in (BLOCK, DROP_OLDEST, COALESCE), f'unknown overflow policy {overflow}'
+        self.handler = handler
+        self.backlog = backlog
+        self.overflow = overflow
+        self.name = name
+        self._workers = [_Worker() for _ in range(workers)]
+        # counters
+        self.handled = 0
+        self.errors = 0
+        self.dropped = 0
+        self.coalesced = 0
+        self.latency = 0.0
+        self.max_latency = 0.0
+        self._total_latency = 0.0
+        self.wait = 0.0
+
+    def __str__(self):
+        return f'WorkerPool <{self.name}>'
+
+    @property
+    def depth(self) -> int:
+        return sum(len(x.backlog) for x in self._workers)
+
+    @property
+    def stats(self) -> dict:
+        return {
+            'depth': self.depth,
+            'handled': self.handled,
+            'errors': self.errors,
+            'dropped': self.dropped,
+            'coalesced': self.coalesced,
+            'latency': self.latency,
+            'avg_latency': self._total_latency / self.handled if self.handled else 0.0,
+            'max_latency': self.max_latency,
+            'wait': self.wait,
+        }
+
+    async def start(self) -> typing.List[asyncio.Task]:
+        """
+        Start workers
+        :return: tasks of workers, cancel them to stop the pool
+        """
+        return [await self._work(x) for x in self._workers]
+
+    async def put(self, key: typing.Hashable, item, coalesce: typing.Hashable = None):
+        """
+        Put item to the worker, chosen by key
+        :param key: items with the same key are handled one by one in the order they were put
+        :param item:
+        :param coalesce: for COALESCE policy: pending item with the same coalesce key is replaced
+        :return:
+        """
+        worker = self._workers[hash(key) % len(self._workers)]
+        backlog = worker.backlog
+        if self.overflow == COALESCE and coalesce is not None:
+            if coalesce in backlog:
+                backlog[coalesce] = (item, backlog[coalesce][1])
+                self.coalesced += 1
+                return
+        else:
+            coalesce = worker.next_key()
+        while len(backlog) >= self.backlog:
+            if self.overflow == DROP_OLDEST:
+                backlog.popitem(last=False)
+                self.dropped += 1
+            else:
+                worker.not_full.clear()
+                await worker.not_full.wait()
+        backlog[coalesce] = (item, time.perf_counter())
+        worker.ready.set()
+
+    @autils.endless_loop
+    @autils.set_logger(logger)
+    async def _work(self, worker: _Worker):
+        if not worker.backlog:
+            worker.ready.clear()
+            await worker.ready.wait()
+            return
+        item, enqueued = worker.backlog.popitem(last=False)[1]
+        worker.not_full.set()
+        started = time.perf_counter()
+        self.wait = started - enqueued
+        try:
+            await self.handler(item)
+        except Exception as err:
+            self.errors += 1
+            logger.exception(f'{self} failed to handle {item}: {err}')
+        finally:
+            self.latency = latency = time.perf_counter() - started
+            self._total_latency += latency
+            if latency > self.max_latency:
+                self.max_latency = latency
+            self.handled += 1
@@ -0,0 +1,307 @@
+"""
+Benchmarks of state propagation, rule fan-out, bindings and app loading on synthetic configs
+
+Run:
+    python -m tests.benchmarks --sizes 10,1000,100000 --output bench.json
+
+Results are printed (or written to output) as JSON, compare files of two runs to find regressions.
+Times are in seconds, latencies in microseconds, memory in bytes
+"""
+import argparse
+import asyncio
+import json
+import platform
+import sys
+import time
+import timeit
+import tracemalloc
+import types
+import typing
+from dataclasses import dataclass, field
+from datetime import datetime
+from functools import partial
+
+DEF_SIZES = (10, 1000, 100000)
+# max number of states, which get subscribers in fan-out benchmark
+FANOUT_STATES = 1000
+SUBSCRIBERS = (0, 1, 100)
+MQTT_PORT = 18840
+MQTT_MESSAGES = 2000
+# number of states made to measure memory per state
+MEMORY_STATES = 100000
+
+
+def make_conf(size: int, binding=None) -> types.ModuleType:
+    """
+    Config module with size Temperature things, bound to binding if it is given
+    """
+    from smarthome import things
+    conf = types.ModuleType(f'conf{size}')
+    conf.__skiproot__ = True
+    if binding is not None:
+        conf.binding = binding
+    for i in range(size):
+        thing = things.Temperature()
+        if binding is not None:
+            thing.bind_to(binding)
+        setattr(conf, f't{i}', thing)
+    return conf
+
+
+def _counting_binding():
+    from smarthome.bindings.binding import Binding
+
+    class Counting(Binding):
+        pushed = 0
+
+        async def start_binding(self):
+            return True
+
+        async def stop_binding(self):
+            pass
+
+        async def push(self, state, **data):
+            self.pushed += 1
+
+    return Counting()
+
+
+async def bench_app(size: int) -> dict:
+    from smarthome import App
+    started = time.perf_counter()
+    conf = make_conf(size, _counting_binding())
+    made = time.perf_counter()
+    app = await App.from_module('bench', conf)
+    loaded = time.perf_counter()
+    await app.start()
+    ret = {
+        'make_conf': made - started,
+        'from_module': loaded - made,
+        'start': time.perf_counter() - loaded,
+    }
+    await app.stop()
+    return ret
+
+
+async def bench_change(size: int) -> dict:
+    """
+    Latency of State.change with 0, 1 and 100 subscribers
+    """
+    from smarthome import App
+    from smarthome.events import bus, CHANGED
+    app = await App.from_module('bench', make_conf(size))
+    states = [x.value for x in app.get_things()][:FANOUT_STATES]
+    ret = {}
+    for subscribers in SUBSCRIBERS:
+        callbacks = [(lambda *args: None) for _ in range(subscribers)]
+        for state in states:
+            for cb in callbacks:
+                bus.subscribe(state, CHANGED, cb)
+        value = 0
+        rounds = max(1, 20000 // len(states))
+        started = time.perf_counter()
+        for _ in range(rounds):
+            value += 1
+            for state in states:
+                await state.change(value)
+        took = time.perf_counter() - started
+        ret[f'change_{subscribers}_subscribers_us'] = took / (rounds * len(states)) * 1e6
+        for state in states:
+            for cb in callbacks:
+                bus.unsubscribe(state, CHANGED, cb)
+    return ret
+
+
+async def bench_push(size: int) -> dict:
+    """
+    Throughput of pushes to binding, made by Thing.bind_to
+    """
+    from smarthome import App
+    binding = _counting_binding()
+    app = await App.from_module('bench', make_conf(size, binding))
+    await app.start()
+    states = [x.value for x in app.get_things()]
+    rounds = max(1, 20000 // len(states))
+    started = time.perf_counter()
+    for i in range(rounds):
+        for state in states:
+            await state.change(i + 1)
+    took = time.perf_counter() - started
+    await app.stop()
+    return {'push_per_second': binding.pushed / took}
+
+
+async def bench_mqtt(size: int, port: int = MQTT_PORT, messages: int = MQTT_MESSAGES) -> dict:
+    """
+    Messages per second handled by MqttBinding, messages are published by a client to local hbmqtt broker
+    """
+    from copy import copy
+    from hbmqtt.broker import Broker, _defaults
+    from hbmqtt.client import MQTTClient
+    from smarthome import App
+    from smarthome.bindings import MqttBinding
+    config = copy(_defaults)
+    config['listeners'] = {
+        'default': {'max-connections': 100, 'type': 'tcp'},
+        'tcp': {'bind': f'127.0.0.1:{port}'},
+    }
+    config['auth'] = {'allow-anonymous': True, 'plugins': ['auth_anonymous']}
+    config['topic-check'] = {'enabled': True, 'plugins': ['topic_taboo']}
+    broker = Broker(config)
+    await broker.start()
+    # hbmqtt broker does not match "+" with thing ids containing dots, so "#" is used
+    binding = MqttBinding(host='127.0.0.1', port=port, subscribe_topic='/{app_name}/#')
+    app = await App.from_module('bench', make_conf(size, binding))
+    await app.start()
+    client = MQTTClient('bench_client')
+    try:
+        await client.connect(f'mqtt://127.0.0.1:{port}')
+        ids = [x.unique_id for x in app.get_things()]
+        topics = [f'/bench/{ids[i % len(ids)]}/value/in' for i in range(messages)]
+        started = time.perf_counter()
+        for i, topic in enumerate(topics):
+            await client.publish(topic, str(i).encode())
+        while binding.stats['handled'] < messages and time.perf_counter() - started < 60:
+            await asyncio.sleep(0.01)
+        took = time.perf_counter() - started
+        return {'mqtt_messages_per_second': binding.stats['handled'] / took}
+    finally:
+        await client.disconnect()
+        await app.stop()
+        await broker.shutdown()
+
+
+@dataclass(eq=False)
+class _LegacyState:
+    """
+    Layout of State before it was slotted: per-instance __dict__, three lists of conditions and own check lambda
+    """
+    converter: typing.Callable = float
+    value: typing.Any = 0
+    thing: typing.Any = field(default=None, init=False)
+    name: str = field(default=None, init=False)
+    changed: list = field(default_factory=lambda: [asyncio.Condition()], init=False)
+    received_update: list = field(default_factory=lambda: [asyncio.Condition()], init=False)
+    received_command: list = field(default_factory=lambda: [asyncio.Condition()], init=False)
+    check: typing.Callable = field(default_factory=lambda: lambda: True)
+    _str: str = 'state'
+
+
+def _allocated(factory, count: int = MEMORY_STATES) -> float:
+    """
+    :return: bytes allocated per one object made by factory
+    """
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        objs = [factory() for _ in range(count)]
+        after = tracemalloc.get_traced_memory()[0]
+    finally:
+        tracemalloc.stop()
+    assert len(objs) == count
+    return (after - before) / count
+
+
+async def bench_state_memory() -> dict:
+    """
+    Bytes allocated per State and per State of the old layout
+    """
+    from smarthome import core, Thing
+
+    class Sensor(Thing):
+        value = core.state(0)
+
+    return {
+        'state_bytes': _allocated(Sensor.__dict__['value']),
+        'legacy_state_bytes': _allocated(partial(_LegacyState, float, 0)),
+    }
+
+
+def bench_import() -> dict:
+    """
+    Cumulative time of "import smarthome" in a fresh interpreter, measured with -X importtime, in microseconds
+    """
+    import subprocess
+    proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import smarthome']
+                          , stderr=subprocess.PIPE, universal_newlines=True, check=True)
+    for line in proc.stderr.splitlines():
+        if line.startswith('import time:') and line.endswith('| smarthome'):
+            return {'import_us': int(line.split('|')[1])}
+    return {}
+
+
+async def bench_payload(count: int = 20000) -> dict:
+    """
+    Ingest of the same MQTT payload: passed raw, as shards do, and decoded to str, as it was done before
+    """
+    from smarthome import things
+    temp = things.Temperature().value
+    payload = bytearray(b'21.5')
+
+    async def ingest(prepare) -> float:
+        started = time.perf_counter()
+        for _ in range(count):
+            await temp.change(prepare(payload))
+        return time.perf_counter() - started
+
+    return {
+        'decoded_payload_us': await ingest(bytearray.decode) / count * 1e6,
+        'raw_payload_us': await ingest(lambda x: x) / count * 1e6,
+    }
+
+
+def bench_proxy() -> dict:
+    """
+    Attribute access of LambdaProxy, made by State operators, with resolution cache and without it
+    """
+    from smarthome import State
+    state = State(float, 1)
+    prox = (state + 1) > 1
+    number = 100000
+    took = min(timeit.repeat(lambda: prox.value, number=number, repeat=3))
+    uncached = min(timeit.repeat(lambda: prox._getattr_uncached('value'), number=number, repeat=3))
+    return {
+        'proxy_access_us': took / number * 1e6,
+        'proxy_uncached_access_us': uncached / number * 1e6,
+    }
+
+
+async def run(sizes: typing.Iterable[int] = DEF_SIZES, mqtt: bool = True) -> dict:
+    ret = {
+        'python': platform.python_version(),
+        'date': datetime.now().isoformat(),
+        'import': bench_import(),
+        'proxy': bench_proxy(),
+        'memory': await bench_state_memory(),
+        'payload': await bench_payload(),
+        'sizes': {},
+    }
+    for size in sizes:
+        res = {}
+        res.update(await bench_app(size))
+        res.update(await bench_change(size))
+        res.update(await bench_push(size))
+        if mqtt:
+            res.update(await bench_mqtt(size))
+        ret['sizes'][str(size)] = res
+    return ret
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', default=','.join(str(x) for x in DEF_SIZES), help='numbers of things')
+    parser.add_argument('--output', default=None, help='json file, stdout by default')
+    parser.add_argument('--no-mqtt', action='store_true', help='skip benchmark with local hbmqtt broker')
+    args = parser.parse_args(argv)
+    sizes = [int(x) for x in args.sizes.split(',')]
+    loop = asyncio.get_event_loop()
+    res = loop.run_until_complete(run(sizes, mqtt=not args.no_mqtt))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(res, f, indent=2)
+    else:
+        json.dump(res, sys.stdout, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,121 @@
+from logging import basicConfig, INFO
+basicConfig(level=INFO)
+import asyncio
+import typing
+
+import pytest
+
+from smarthome import core, Thing
+
+
+@pytest.mark.asyncio
+async def test_state_slots():
+    from smarthome.events import bus, CHANGED
+
+    class Sensor(Thing):
+        value = core.state(0)
+
+    state = Sensor.__dict__['value']()
+    assert not hasattr(state, '__dict__')
+    with pytest.raises(AttributeError):
+        state.foo = 1
+    # default check is shared and nothing is allocated for events until the first subscription
+    assert state.check is Sensor.__dict__['value']().check
+    assert not bus.has_listeners(state, CHANGED)
+
+
+def test_proxy_access():
+    from unittest.mock import patch
+    from smarthome import State
+    from smarthome.utils.proxy import LambdaProxy
+    state = State(float, 1)
+    prox = (state + 1) > 1
+    names = ['value', 'check', 'rule', 'name', '_str']
+
+    assert [getattr(prox, x) for x in ['value', '_str', 'name']] \
+        == [prox._getattr_uncached(x) for x in ['value', '_str', 'name']]
+
+    resolve = LambdaProxy._resolve
+    resolved = []
+
+    def counting(self, item):
+        resolved.append(item)
+        return resolve(self, item)
+
+    with patch.object(LambdaProxy, '_resolve', counting):
+        prox = (state + 1) > 1
+        resolved.clear()
+        for _ in range(3):
+            for x in names:
+                getattr(prox, x)
+        # every attribute is resolved once, then got from cache
+        assert sorted(resolved) == sorted(names)
+        state.value = 5
+        assert prox.value == 6
+        # changing overrides drops the cache
+        prox._kwargs['_str'] = 'changed'
+        assert prox._str == 'changed'
+        assert resolved.count('_str') == 2
+
+
+# modules that must not be loaded by bare "import smarthome"
+HEAVY_MODULES = ('hbmqtt', 'megad', 'astral', 'yaml', 'sqlalchemy')
+
+
+def loaded_modules(statement: str) -> typing.Set[str]:
+    """
+    Run statement in a fresh interpreter
+    :return: names of modules loaded after it
+    """
+    import subprocess
+    import sys
+    proc = subprocess.run([sys.executable, '-c', f'{statement}\nimport sys\nprint("\\n".join(sys.modules))']
+                          , stdout=subprocess.PIPE, universal_newlines=True, check=True)
+    return set(proc.stdout.split())
+
+
+def test_lazy_import():
+    modules = loaded_modules('import smarthome')
+    eager = sorted(x for x in modules if x.split('.')[0] in HEAVY_MODULES)
+    assert not eager, f'heavy modules are imported eagerly: {eager}'
+
+    modules = loaded_modules('from smarthome.bindings import MqttBinding')
+    assert 'hbmqtt' in modules and 'megad' not in modules
+
+    import smarthome
+    assert {'App', 'bindings'} <= set(dir(smarthome))
+    with pytest.raises(AttributeError):
+        smarthome.nothing
+
+
+@pytest.mark.asyncio
+async def test_repeated_payload():
+    from unittest.mock import patch
+    from smarthome import things, state
+    temp = things.Temperature().value
+    decoded = []
+
+    def from_bytes(converter, raw):
+        decoded.append(raw)
+        return converter(raw)
+
+    with patch.object(state, 'from_bytes', from_bytes):
+        for _ in range(100):
+            await temp.change(bytearray(b'21.5'))
+        # repeated payload is decoded only once
+        assert decoded == [b'21.5'] and temp.value == 21.5
+        # plain assignment drops raw, so the same payload is decoded again
+        temp.value = 0
+        assert temp.raw is None
+        await temp.change(b'21.5')
+        assert decoded == [b'21.5', b'21.5'] and temp.raw == b'21.5'
+
+
+@pytest.mark.asyncio
+async def test_benchmarks_smoke():
+    import json
+    from tests import benchmarks
+    res = await benchmarks.run([10], mqtt=False)
+    json.dumps(res)
+    assert set(res['payload']) == {'raw_payload_us', 'decoded_payload_us'}
+    assert set(res['sizes']['10']) >= {'from_module', 'start', 'change_100_subscribers_us', 'push_per_second'}
@@ -0,0 +1,41 @@
+import re
+
+import pytest
+
+from mqtt_decorator.decorator import Subscriptions, Callback
+
+
+def test_subscriptions_match():
+    subs = Subscriptions()
+    exact = Callback(lambda *args: 'exact')
+    single = Callback(lambda *args: 'single')
+    multi = Callback(lambda *args: 'multi')
+    patt = Callback(lambda *args: 'patt', parse_topic=True)
+    subs['/home/light/in'] = exact
+    subs['/home/+/in'] = single
+    subs['/home/#'] = multi
+    subs[re.compile(r'/home/(?P<thing>\w+)/in')] = patt
+
+    found = subs.match('/home/light/in')
+    assert [x for x, _ in found] == [exact, multi, single, patt]
+    assert found[-1][1] == {'thing': 'light'}
+    assert [x for x, _ in subs.match('/home')] == [multi]
+    assert [x for x, _ in subs.match('/home/light/out')] == [multi]
+    assert subs.match('/other/light/in') == []
+    assert subs['/home/light/in'] == (exact, '/home/light/in')
+
+    del subs['/home/#']
+    del subs['/home/+/in']
+    assert [x for x, _ in subs.match('/home/light/in')] == [exact, patt]
+    assert len(subs) == 2
+    with pytest.raises(KeyError):
+        subs['/home/light/out']
+
+
+def test_subscriptions_system_topics():
+    subs = Subscriptions()
+    cb = Callback(lambda *args: None)
+    subs['#'] = cb
+    subs['+/broker'] = cb
+    assert subs.match('$SYS/broker') == []
+    assert len(subs.match('home/broker')) == 2
@@ -4,6 +4,7 @@ basicConfig(level=DEBUG, format='%(asctime)s:%(levelname)s:%(message)s')
 
 from pytest import fixture, yield_fixture
 import secrets
+import os
 import asyncio
 import pytest
 from hbmqtt.client import MQTTClient
@@ -19,9 +20,11 @@ from unittest.mock import patch
 from asyncio_primitives import utils as autils
 import yaml
 from multiprocessing import Process, Manager, synchronize, Lock, Pipe, connection, Queue
+from .utils import DummyBinding, make_conf
 
 HOST = '127.0.0.1'
 PORT = 1889
+BROKER_CONFIG = os.path.join(os.path.dirname(__file__), 'broker.yml')
 
 
 @fixture(scope='module')
@@ -31,17 +34,20 @@ def broker():
 
     def main(lck: synchronize.Lock, send: Queue):
         async def run():
-            with open('broker.yml') as f:
+            with open(BROKER_CONFIG) as f:
                 config = yaml.load(f, yaml.FullLoader)
             brok = Broker(config)
             await brok.start()
             send.put(True)
 
-            with lck:
-                pass
+            # serve until the parent releases the lock, lock is awaited in a thread not to block the broker
+            await asyncio.get_event_loop().run_in_executor(None, lck.acquire)
+            lck.release()
             await brok.shutdown()
 
-        loop = asyncio.get_event_loop()
+        # forked process must not share the selector of the parent's loop
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
         loop.run_until_complete(run())
 
     proc = Process(target=main, args=[lck,  send])
@@ -128,4 +134,386 @@ async def test_names(app, conf):
 @pytest.mark.asyncio
 async def test_push_mqtt(mqtt_client, app, conf):
     await conf.hello_switch.is_on.change(True)
-    await asyncio.sleep(2)
\ No newline at end of file
+    await asyncio.sleep(2)
+
+@pytest.mark.asyncio
+async def test_mqtt_flush(make_conf):
+    from smarthome import things
+    conf = make_conf(async_mqtt.MqttBinding(host=HOST, port=PORT, max_batch=2, retry_delay=0.05))
+    for i in range(5):
+        setattr(conf, f'lamp{i}', things.Switch().bind_to(conf.binding))
+    app = await App.from_module('test', conf)
+    states = [getattr(conf, f'lamp{i}').is_on for i in range(5)]
+
+    published = []
+    failing = {'/test/switch.lamp1/is_on/out'}
+    blocked = asyncio.Event()
+
+    async def publish(topic, message):
+        await blocked.wait()
+        if topic in failing:
+            raise ConnectionError(topic)
+        published.append((topic, message))
+
+    conf.binding.mqtt.publish = publish
+    for x in states:
+        await conf.binding.push(x)
+
+    # flush cancelled before publishes are done loses nothing
+    task = asyncio.ensure_future(conf.binding.flush())
+    await asyncio.sleep(0.01)
+    task.cancel()
+    await asyncio.gather(task, return_exceptions=True)
+    assert conf.binding.queue_depth == 5 and not published
+
+    blocked.set()
+    await conf.binding.flush()
+    assert [x for x, _ in published] == [f'/test/switch.lamp{i}/is_on/out' for i in (0, 2, 3, 4)]
+    assert conf.binding.stats['publish_errors'] == 1 and conf.binding.batches == 3
+    # failed message stays in the queue and is published with the next flush
+    assert conf.binding.queue_depth == 1
+    # failed message is retried by flush loop without another push, with backoff
+    assert conf.binding._next_retry_delay == 0.05
+    task = await conf.binding._flush_loop()
+    await asyncio.sleep(0.08)
+    assert conf.binding._next_retry_delay == 0.1 and conf.binding.queue_depth == 1
+    failing.clear()
+    await asyncio.sleep(0.2)
+    assert published[-1] == ('/test/switch.lamp1/is_on/out', b'False')
+    assert conf.binding.queue_depth == 0 and conf.binding._next_retry_delay == 0
+    await utils.utils.cancel_tasks(task)
+
+
+@pytest.mark.asyncio
+async def test_parallel_start():
+    import time
+    from smarthome import App, things
+
+    class Slow(DummyBinding):
+        name = 'slow'
+
+        async def start_binding(self):
+            await asyncio.sleep(0.2)
+            return True
+
+    class Hanging(Slow):
+        name = 'hanging'
+        start_timeout = 0.1
+
+        async def start_binding(self):
+            await asyncio.sleep(10)
+
+    class MyApp(App):
+        b1 = Slow()
+        b2 = Slow()
+        b3 = Hanging()
+        lamp = things.Switch().bind_to(b3)
+        fan = things.Switch().bind_to(b1).bind_to(b3)
+
+    app = MyApp()
+    started = time.perf_counter()
+    await app.start()
+    took = time.perf_counter() - started
+    # bindings are started together, hanging one is cancelled by timeout
+    assert took < 0.5
+    assert app.lamp.bound_to == [app.b3]
+    assert app.startup_timings[f'binding hanging@{id(app.b3):x}'] < 0.2
+    # bindings with the same name are timed apart
+    assert len([x for x in app.startup_timings if x.startswith('binding slow@')]) == 2
+    # failed binding is reported, thing bound only to it is skipped, thing with a live binding is started
+    assert isinstance(app.startup_errors[f'binding hanging@{id(app.b3):x}'], asyncio.TimeoutError)
+    assert 'thing switch.lamp' in app.startup_errors and 'thing switch.lamp' not in app.startup_timings
+    assert 'thing switch.fan' in app.startup_timings and len(app.startup_errors) == 2
+    await app.stop()
+
+    class DeadApp(App):
+        b1 = Hanging()
+
+    app = DeadApp()
+    # app with no started bindings fails to start
+    with pytest.raises(RuntimeError):
+        await app.start()
+    await app.stop()
+
+
+@pytest.mark.asyncio
+async def test_app_indexes(make_conf):
+    from smarthome import Group, Thing, things
+
+    class Dimmable:
+        pass
+
+    class Dimmer(Dimmable, things.Switch):
+        pass
+
+    conf = make_conf()
+    conf.grp = Group()
+    conf.lamp = things.Switch(conf.grp).bind_to(conf.binding)
+    conf.temp = things.Temperature(conf.grp)
+    conf.button = things.Button()
+    conf.dimmer = Dimmer()
+
+    app = await App.from_module('test', conf)
+    assert app.get_thing('switch.lamp') is conf.lamp
+    assert app.get_thing('switch.nothing') is None
+    assert app.things_by_type(things.Switch) == [conf.lamp, conf.dimmer]
+    # mixins declared before Thing are indexed too
+    assert app.things_by_type(Dimmable) == [conf.dimmer]
+    assert len(app.things_by_type(Thing)) == 4
+    assert app.things_by_root('temp') == [conf.temp]
+    # callers get copies, indexes stay intact
+    app.things_by_root('temp').clear()
+    app.things_by_type(Thing).clear()
+    assert app.things_by_root('temp') == [conf.temp] and len(app.things_by_type(Thing)) == 4
+    assert app.groups['grp'] is conf.grp
+    assert app.things_by_binding(conf.binding) == []
+    await app.start()
+    assert app.things_by_binding(conf.binding) == [conf.lamp]
+    await app.stop()
+
+
+@pytest.mark.asyncio
+async def test_binding_index(make_conf):
+    from smarthome import things
+    from smarthome.bindings import MqttBinding
+
+    conf = make_conf(MqttBinding(host='127.0.0.1'))
+    conf.lamp = things.Switch().bind_to(conf.binding)
+
+    app = await App.from_module('test', conf)
+    await app.get_thing('switch.lamp').prepare()
+    assert conf.binding.things == {'switch.lamp': conf.lamp}
+    assert conf.binding.resolve('/test/switch.lamp/is_on/in') is conf.lamp.is_on
+    assert conf.binding.route('/test/switch.lamp/is_on/in') is conf.lamp.is_on
+    assert conf.binding.get_subscribed_thing('switch.lamp') is conf.lamp
+    # handle_msg routes message by itself
+    await conf.binding.handle_msg(ApplicationMessage(None, '/test/switch.lamp/is_on/in', 0, b'on', False))
+    assert conf.lamp.is_on.value is True
+
+
+@pytest.mark.asyncio
+async def test_bad_address(make_conf):
+    from smarthome import things
+
+    class Strict(DummyBinding):
+
+        def get_address(self, state, data):
+            if 'pin' not in data:
+                raise RuntimeError(f'{state.thing.unique_id}: "pin" keyword is not provided')
+            return data['pin']
+
+    conf = make_conf(Strict())
+    conf.bad = things.Switch().bind_to(conf.binding)
+    conf.lamp = things.Switch().bind_to(conf.binding, pin=1)
+
+    app = await App.from_module('test', conf)
+    # one misconfigured thing does not stop the app
+    await app.start()
+    assert conf.binding.resolve(1) is conf.lamp.is_on
+    assert app.things_by_binding(conf.binding) == [conf.bad, conf.lamp]
+    await app.stop()
+
+
+@pytest.mark.asyncio
+async def test_mqtt_shards(broker, make_conf):
+    from smarthome import things
+    from smarthome.bindings import MqttBinding
+
+    conf = make_conf(MqttBinding(host=HOST, port=PORT, shards=3, workers=4, client_id='test_shards'))
+    switches = [things.Switch().bind_to(conf.binding) for _ in range(12)]
+    for i, x in enumerate(switches):
+        setattr(conf, f'switch{i}', x)
+    payloads = [b'on', b'off', b'on']
+    received = {}
+    trigger_state = conf.binding.trigger_state
+
+    async def record(state, value, is_command=False):
+        received.setdefault(state.thing.unique_id, []).append(value)
+        await trigger_state(state, value, is_command=is_command)
+
+    app = await App.from_module('test', conf)
+    client = MQTTClient('test_shards_client')
+    with patch.object(conf.binding, 'trigger_state', record):
+        await app.start()
+        try:
+            assert all(x.topics for x in conf.binding.shards)
+            await client.connect(f'mqtt://{HOST}:{PORT}')
+            for data in payloads:
+                for i in range(12):
+                    await client.publish(f'/test/switch.switch{i}/is_on/in', data)
+            await asyncio.sleep(0.5)
+        finally:
+            await client.disconnect()
+            await app.stop()
+    # every shard got its part of messages, messages of every topic are handled in the order they were published
+    stats = conf.binding.stats
+    assert all(x['received'] for x in stats['shards'])
+    assert sum(x['received'] for x in stats['shards']) == stats['handled'] == 36
+    assert received == {f'switch.switch{i}': payloads for i in range(12)}
+    assert all(x.is_on.value for x in switches)
+
+
+@pytest.mark.asyncio
+async def test_state_store(tmp_path):
+    from smarthome import things
+    from smarthome.store import StateStore
+
+    # store is shared by apps of the class, it is started again with the next app
+    store = StateStore(str(tmp_path / 'states.db'), flush_interval=10, max_pending=3)
+
+    def make_app():
+        class MyApp(App):
+            lamp = things.Switch()
+            temp = things.Temperature()
+            dim = things.Dimmer()
+        MyApp.store = store
+        return MyApp()
+
+    app = make_app()
+    await app.start()
+    await app.store.flush()
+    assert app.store.written == 3
+    await app.lamp.is_on.change(True)
+    await app.temp.value.change(21.5)
+    assert app.store.pending == 2
+    # third change fills the buffer, it is flushed without waiting for interval
+    await app.dim.dim_level.change(50)
+    await asyncio.sleep(0.1)
+    assert app.store.pending == 0 and app.store.flushes == 2
+    await app.temp.value.change(22.5)
+    await app.stop()
+
+    app = make_app()
+    shifted = (app.temp.value + 1).computed()
+    await app.temp.value.change(b'20')
+    assert shifted.value == 21
+    await app.start()
+    # restored value invalidates computed states and drops raw payload
+    assert shifted.value == 23.5 and app.temp.value.raw is None
+    assert app.lamp.is_on.value is True
+    assert app.temp.value.value == 22.5
+    assert app.dim.dim_level.value == 50
+    executor = store._executor
+    await app.stop()
+    # database thread is stopped
+    assert executor._shutdown and store._executor is None
+
+
+@pytest.mark.asyncio
+async def test_event_log(tmp_path, make_conf):
+    import threading
+    from smarthome import things, eventlog
+
+    conf = make_conf()
+    conf.lamp = things.Switch().bind_to(conf.binding)
+    conf.temp = things.Temperature().bind_to(conf.binding)
+    app = await App.from_module('test', conf)
+    await app.start()
+
+    path = str(tmp_path / 'log')
+    log = eventlog.EventLog(path, segment_size=200)
+    log.attach(conf.lamp, conf.temp)
+    fsync = os.fsync
+    synced_in = set()
+
+    def record(fd):
+        synced_in.add(threading.get_ident())
+        fsync(fd)
+
+    with patch.object(os, 'fsync', record):
+        for x in range(5):
+            await conf.binding.trigger_subscription('temp.temp', 'value', f'{20 + x}')
+        await log.sync()
+        await conf.binding.trigger_subscription('switch.lamp', 'is_on', True, is_command=True)
+        await log.close()
+    # segments are fsynced out of the loop thread
+    assert synced_in and threading.get_ident() not in synced_in
+    assert len(eventlog.segments(path)) > 1 and log.fsyncs >= len(eventlog.segments(path))
+    records = list(eventlog.read(path))
+    assert [x.value for x in records if x.event == eventlog.RECEIVED_UPDATE] == [20.0, 21.0, 22.0, 23.0, 24.0]
+    assert records[-1].event == eventlog.RECEIVED_COMMAND and records[-1].source == 'binding'
+    # truncated record at the end is skipped
+    last = eventlog.segments(path)[-1]
+    with open(last, 'ab') as f:
+        f.write(eventlog.pack(0, eventlog.CHANGED, 'x', 'y', 1, '')[:-3])
+    assert len(list(eventlog.read(path))) == len(records)
+
+    await conf.temp.value.change(0)
+    await conf.lamp.is_on.change(False)
+    assert await eventlog.replay(conf.binding, path, speed=None) == 6
+    assert conf.temp.value.value == 24.0 and conf.lamp.is_on.value is True
+    await app.stop()
+
+    # closed log can be opened again, it continues with the next segment
+    count = len(eventlog.segments(path))
+    log.write(eventlog.CHANGED, 'temp.temp', 'value', 1)
+    await log.close()
+    assert len(eventlog.segments(path)) == count + 1 and list(eventlog.read(path))[-1].value == 1
+
+
+@pytest.mark.asyncio
+async def test_metrics(tmp_path, make_conf):
+    from smarthome import things, events, metrics
+
+    conf = make_conf()
+    conf.temp = things.Temperature().bind_to(conf.binding)
+    conf.outdoor = things.Temperature().bind_to(conf.binding)
+    app = await App.from_module('test', conf)
+    app.metrics_port = 18850
+    changes = metrics.STATE_CHANGES.value
+    await app.start()
+    assert metrics.registry.enabled
+
+    calls = []
+
+    def on_change():
+        calls.append(1)
+        if len(calls) == 2:
+            raise ValueError('test')
+
+    task = await events.rule(*conf.temp.value.changed)(on_change)()
+    for x in range(3):
+        await conf.binding.trigger_subscription('temp.temp', 'value', f'{20 + x}')
+        await asyncio.sleep(0)
+    await conf.binding.trigger_subscription('temp.outdoor', 'value', '5')
+    await asyncio.sleep(0)
+    task.cancel()
+    assert len(calls) == 3
+    assert metrics.STATE_CHANGES.value - changes == 4
+    assert metrics.RULE_ERRORS.labels(on_change.__qualname__).value == 1
+    # generated push rules are told apart by their names
+    pushes = {x: y.value for (x, ), y in metrics.RULE_RUNS._children.items() if x.startswith('push temp.')}
+    assert sorted(pushes.values()) == [1, 3] and len(pushes) == 2
+    assert all(metrics.RULE_SECONDS.labels(x).count == pushes[x] for x in pushes)
+
+    mqtt = async_mqtt.MqttBinding(host=HOST)
+    mqtt.name = 'mqtt'
+    await mqtt.push(conf.temp.value)
+
+    reader, writer = await asyncio.open_connection('127.0.0.1', 18850)
+    writer.write(b'GET /metrics HTTP/1.1\r\nHost: localhost\r\n\r\n')
+    response = (await reader.read()).decode()
+    writer.close()
+    assert response.startswith('HTTP/1.1 200 OK')
+    assert '# TYPE smarthome_state_changes_total counter' in response
+    assert 'smarthome_binding_triggers_total{binding="binding"} 4' in response
+    assert 'smarthome_mqtt_out_queue{binding="mqtt"} 1' in response
+    assert f'smarthome_rule_runs_total{{rule="{on_change.__qualname__}"}} 3' in response
+    assert f'smarthome_rule_seconds_bucket{{rule="{on_change.__qualname__}",le="+Inf"}} 3' in response
+
+    path = str(tmp_path / 'smarthome.prom')
+    metrics.registry.dump(path)
+    with open(path) as f:
+        assert f'smarthome_rule_seconds_count{{rule="{on_change.__qualname__}"}} 3' in f.read()
+
+    # metrics are disabled when app is stopped, disabled metrics are not collected
+    await app.stop()
+    assert not metrics.registry.enabled
+    await conf.binding.trigger_subscription('temp.temp', 'value', '30')
+    assert metrics.RULE_RUNS.labels(on_change.__qualname__).value == 3
+
+    hist = metrics.Histogram('h', buckets=(1, 5))
+    for x in (0.5, 1, 3, 10):
+        hist.observe(x)
+    assert list(hist._samples(())) == [
+        'h_bucket{le="1"} 2', 'h_bucket{le="5"} 3', 'h_bucket{le="+Inf"} 4', 'h_sum 14.5', 'h_count 4']
@@ -82,6 +82,8 @@ async def test_states():
 
     await st1.change(False)
     await st2.change(False)
+    # rules run in their own tasks
+    await asyncio.sleep(0)
 
     with async_utils.ignoreerror(asyncio.CancelledError):
         task.cancel()
@@ -109,6 +111,7 @@ async def test_complex_rule():
     await st2.change(1)
     await st2.change(2)
     await st1.change(3)
+    await asyncio.sleep(0)
     assert hitcnt == 2
 
     with async_utils.ignoreerror(asyncio.CancelledError):
@@ -126,6 +129,7 @@ async def test_complex_rule():
     await st1.change(1)
     await st2.change(1)
     await st2.change(6)
+    await asyncio.sleep(0)
 
     assert hitcnt == 4
     with async_utils.ignoreerror(asyncio.CancelledError):
@@ -196,3 +200,466 @@ async def test_timeshed_multi():
         task.cancel()
         await task
 
+
+
+@pytest.mark.asyncio
+async def test_coalescer():
+    pushed = []
+    value = 0
+
+    async def push():
+        pushed.append(value)
+
+    coalesced = utils.Coalescer(push, 0.1)
+    for x in range(1, 51):
+        value = x
+        await coalesced()
+        await asyncio.sleep(0.005)
+    await asyncio.sleep(0.3)
+    assert pushed[0] == 1
+    assert pushed[-1] == 50
+    assert len(pushed) <= 5
+
+    # stopped coalescer drops the pending call
+    pushed.clear()
+    await coalesced()
+    await asyncio.sleep(0.01)
+    await coalesced()
+    await coalesced.stop()
+    await asyncio.sleep(0.2)
+    assert pushed == [50] and coalesced._task is None
+
+
+@pytest.mark.asyncio
+async def test_event_bus():
+    from smarthome import things
+    from smarthome.events import bus, CHANGED, RECEIVED_UPDATE
+    st = things.Number().value
+    assert not bus.has_listeners(st, CHANGED)
+    await st.change(1)
+
+    que = asyncio.Queue()
+    calls = []
+    put = bus.subscribe_queue(st, CHANGED, que)
+    cb = bus.subscribe(st, RECEIVED_UPDATE, lambda *args: calls.append(args))
+    await st.update('2', _from='test')
+    assert st.value == 2
+    assert que.get_nowait() == (st, CHANGED, 'test')
+    assert calls == [(st, RECEIVED_UPDATE, 'test')]
+
+    bus.unsubscribe(st, CHANGED, put)
+    bus.unsubscribe(st, RECEIVED_UPDATE, cb)
+    assert not bus.has_listeners(st, CHANGED)
+    await st.update('3')
+    assert que.empty()
+    assert len(calls) == 1
+
+    # publisher does not wait for rules
+    from smarthome.events import rule
+    release = asyncio.Event()
+
+    @rule(*st.changed)
+    async def slow():
+        calls.append('started')
+        await release.wait()
+        calls.append('done')
+
+    task = await slow()
+    await asyncio.wait_for(st.change(4), 0.1)
+    await asyncio.sleep(0)
+    assert calls[-1] == 'started'
+    release.set()
+    await asyncio.sleep(0)
+    assert calls[-1] == 'done'
+    task.cancel()
+
+    # runs of one rule do not overlap and keep the order of events
+    runs = []
+
+    @rule(*st.changed)
+    async def sequential():
+        run = sum(1 for x in runs if x[0] == 'started')
+        runs.append(('started', run))
+        # the first run is the slowest one, concurrent runs would finish in reverse order
+        await asyncio.sleep(0.02 if run == 0 else 0)
+        runs.append(('done', run))
+
+    task = await sequential()
+    await st.change(5)
+    await st.change(6)
+    await asyncio.sleep(0.05)
+    assert runs == [('started', 0), ('done', 0), ('started', 1), ('done', 1)]
+    task.cancel()
+
+    # bus does not keep sources alive
+    import gc
+    from smarthome import State
+    tmp = State(float)
+    bus.subscribe(tmp, CHANGED, lambda *args: None)
+    key = id(tmp)
+    del tmp
+    gc.collect()
+    assert key not in bus._subscribers
+
+
+def test_compiled_expression():
+    from smarthome import State
+    st1 = State(float, 1)
+    st2 = State(float, 2)
+    prod = (st1 + 5) * st2
+    cond = (prod > 10) & (st2 == 2)
+    assert prod.value == 12
+    assert prod.sources == (st1, st2)
+    assert cond.check()
+    # flat function, that reads states directly, without nested proxies
+    assert cond.check.__source__.count('.value') == 3
+    assert [x.source for x in cond.changed] == [st1, st2]
+    st1.value = 0
+    assert prod.value == 10
+    assert not cond.check()
+
+
+def test_proxy_cache():
+    from smarthome.utils.proxy import proxy
+
+    class TestObj:
+        value = 1
+
+        def double(self):
+            return self.value * 2
+
+    obj = TestObj()
+    mut = proxy(obj, value=lambda x: x + 1)
+    assert mut.double() == 4
+    assert mut.double is mut.double
+    obj.value = 2
+    assert mut.double() == 6
+    mut._kwargs['value'] = 10
+    assert mut.value == 10
+    assert mut.double() == 20
+    del mut._kwargs['value']
+    assert mut.double() == 4
+
+
+@pytest.mark.asyncio
+async def test_computed_diamond():
+    from smarthome import things
+    a = things.Number().value
+    left = (a + 1).computed()
+    right = (a * 2).computed()
+    total = (left + right).computed()
+    cells = [x.value_node.cell for x in [left, right, total]]
+
+    assert total.value == 1
+    assert total.value == 1
+    assert [x.computations for x in cells] == [1, 1, 1]
+    await a.change(2)
+    assert all(x.dirty for x in cells)
+    assert total.value == 7
+    assert left.value == 3
+    assert [x.computations for x in cells] == [2, 2, 2]
+    # plain assignment invalidates dependents too
+    a.value = 3
+    assert total.value == 10
+
+    # dropped computed state is collected, its source does not keep it
+    import gc
+    import weakref
+    tmp = (a - 1).computed()
+    assert tmp.value == 2
+    cell = weakref.ref(tmp.value_node.cell)
+    del tmp
+    gc.collect()
+    assert cell() is None and len(a._dependents) == 2
+
+
+@pytest.mark.asyncio
+async def test_edge_rule():
+    from smarthome import things, rule
+    temp = things.Temperature().value
+    hits = []
+
+    @rule(temp <= 20, edge=True, hysteresis=0.5)
+    async def heat():
+        hits.append(temp.value)
+
+    task = await heat()
+    for x in [21, 20, 19, 18, 20.3, 19, 20.6, 20.1, 19]:
+        await temp.change(x)
+        await asyncio.sleep(0)
+    assert hits == [20, 19]
+    task.cancel()
+
+    hits.clear()
+
+    @rule(temp > 25, hold=0.2)
+    async def cool():
+        hits.append(temp.value)
+
+    task = await cool()
+    await temp.change(26)
+    await asyncio.sleep(0.1)
+    await temp.change(24)
+    await temp.change(27)
+    await temp.change(28)
+    assert hits == []
+    await asyncio.sleep(0.3)
+    assert hits == [28]
+    task.cancel()
+
+    # events have no condition, edge options are not ignored silently
+    with pytest.raises(TypeError):
+        rule(temp.changed, edge=True)
+
+
+@pytest.mark.asyncio
+async def test_scheduler_fast_forward():
+    from datetime import datetime, timedelta
+    from smarthome.utils.scheduler import Scheduler
+    now = datetime(2020, 1, 1)
+    sched = Scheduler(clock=lambda: now)
+    hits = []
+
+    sched.call_at(now + timedelta(hours=1), hits.append, 'once')
+    cancelled = sched.call_later(timedelta(hours=2), hits.append, 'cancelled')
+    sched.repeat(timedelta(minutes=25), hits.append, 'repeat')
+    cancelled.cancel()
+    assert sched.pending == 2
+
+    now += timedelta(minutes=30)
+    assert sched.run_due() == 1
+    now += timedelta(hours=3)
+    # missed repeats are skipped, fixed rate is kept
+    assert sched.run_due() == 2
+    assert hits == ['repeat', 'repeat', 'once']
+    assert sched._heap[0][0] == (datetime(2020, 1, 1) + timedelta(minutes=225)).timestamp()
+    sched.cancel_all()
+    assert sched.pending == 0
+
+    # tasks of coroutine callbacks are kept and cancelled with their timer or with cancel_all
+    release = asyncio.Event()
+
+    async def slow(tag):
+        hits.append(tag)
+        await release.wait()
+        hits.append(f'{tag} done')
+
+    timer = sched.call_later(timedelta(minutes=1), slow, 'timer')
+    sched.call_later(timedelta(minutes=1), slow, 'all')
+    now += timedelta(minutes=1)
+    sched.run_due()
+    await asyncio.sleep(0)
+    tasks = list(sched._tasks)
+    assert len(tasks) == 2 and hits[-2:] == ['timer', 'all']
+    timer.cancel()
+    await asyncio.sleep(0.01)
+    assert len(sched._tasks) == 1
+    sched.cancel_all()
+    await asyncio.sleep(0.01)
+    release.set()
+    await asyncio.sleep(0.01)
+    assert all(x.cancelled() for x in tasks) and not sched._tasks
+    assert hits[-1] == 'all'
+
+
+def test_scheduler_new_loop():
+    from smarthome.utils.scheduler import Scheduler
+    sched = Scheduler()
+    hits = []
+
+    async def schedule(*delays):
+        for x in delays:
+            sched.call_later(x, hits.append, x)
+
+    old = asyncio.new_event_loop()
+    old.run_until_complete(schedule(0.05))
+    old.close()
+
+    # the nearest deadline is the same, but timer must be armed on the new loop
+    loop = asyncio.new_event_loop()
+    try:
+        loop.run_until_complete(schedule(1))
+        loop.run_until_complete(asyncio.sleep(0.1))
+    finally:
+        loop.close()
+    assert hits == [0.05]
+
+
+def test_sun_calendar():
+    from datetime import timedelta
+    from smarthome.utils import Sun, CustomTime
+    sun = Sun('moscow')
+    assert Sun('moscow').calendar is sun.calendar
+    sunset = sun.get_time('sunset').time
+    assert CustomTime.now() < sunset <= CustomTime.now() + timedelta(days=1)
+    assert sun.get_time('sunset', offset=timedelta(minutes=5)).time == sunset + timedelta(minutes=5)
+    later = sun.calendar.next_time('sunset', (CustomTime.now() + timedelta(days=500)).timestamp())
+    assert later > (CustomTime.now() + timedelta(days=500)).timestamp()
+
+    # queries of the past extend calendar backwards, alternating queries compute every day once
+    from unittest.mock import patch
+    from smarthome.utils.sun import SunCalendar
+    calendar = SunCalendar(sun.loc, days=30)
+    now = CustomTime.now().timestamp()
+    past = (CustomTime.now() - timedelta(days=20)).timestamp()
+    compute = calendar._compute
+    with patch.object(calendar, '_compute', side_effect=compute) as computed:
+        expected = [calendar.next_time('sunset', x) for x in (now, past)]
+        for _ in range(3):
+            assert [calendar.next_time('sunset', x) for x in (now, past)] == expected
+        assert computed.call_count == 2
+    assert expected == [sun.calendar.next_time('sunset', x) for x in (now, past)]
+    assert list(calendar._times['sunset']) == sorted(calendar._times['sunset'])
+
+
+def test_simulation():
+    import time
+    from datetime import datetime, timedelta
+    from smarthome import things, rule
+    from smarthome.utils import simulation, CustomTime, TimeTracker
+    start = datetime(2020, 1, 1)
+
+    async def main():
+        temp = things.Temperature().value
+        heats = []
+        hours = []
+
+        @rule(temp < 20, edge=True)
+        async def heat():
+            heats.append(CustomTime.now())
+
+        @TimeTracker.repeat(timedelta(hours=1))
+        async def hourly():
+            hours.append(CustomTime.now())
+
+        tasks = [await heat(), await hourly()]
+        # a day of minute samples: 22 degrees on even hours, 18 degrees on odd ones
+        records = [(start + timedelta(minutes=x), temp, 18 if (x // 60) % 2 else 22) for x in range(24 * 60)]
+        await simulation.replay(records)
+        await asyncio.sleep(60)
+        await utils.utils.cancel_tasks(*tasks)
+        return heats, hours
+
+    started = time.perf_counter()
+    heats, hours = simulation.run(main(), start=start)
+    assert time.perf_counter() - started < 10
+    assert len(heats) == 12
+    assert heats[0] == start + timedelta(hours=1)
+    assert len(hours) == 24
+    assert hours[-1] == start + timedelta(hours=24)
+
+
+def test_simulation_without_loop():
+    from smarthome.utils import simulation
+    # eg after asyncio.run
+    asyncio.set_event_loop(None)
+    assert simulation.run(asyncio.sleep(3600, result=1)) == 1
+    with pytest.raises(RuntimeError):
+        asyncio.get_event_loop()
+
+
+@pytest.mark.asyncio
+async def test_worker_pool():
+    from smarthome.utils import workers
+
+    handled = []
+
+    async def handle(item):
+        key, value = item
+        # the first key is slow, it must not block the others
+        await asyncio.sleep(0.05 if key == 'slow' else 0)
+        handled.append(item)
+
+    pool = workers.WorkerPool(handle, workers=2)
+    # key of the other worker
+    fast = next(x for x in range(10) if hash(x) % 2 != hash('slow') % 2)
+    tasks = await pool.start()
+    for i in range(5):
+        await pool.put('slow', ('slow', i))
+        await pool.put(fast, ('fast', i))
+    await asyncio.sleep(0.01)
+    assert [x for x in handled if x[0] == 'fast'] == [('fast', i) for i in range(5)]
+    await asyncio.sleep(0.3)
+    assert [x for x in handled if x[0] == 'slow'] == [('slow', i) for i in range(5)]
+    assert pool.stats['handled'] == 10 and pool.depth == 0
+    await utils.utils.cancel_tasks(*tasks)
+
+    # workers are not started, so backlog is not consumed
+    pool = workers.WorkerPool(handle, workers=1, backlog=2, overflow=workers.DROP_OLDEST)
+    for i in range(4):
+        await pool.put('x', ('x', i))
+    assert pool.dropped == 2 and pool.depth == 2
+
+    pool = workers.WorkerPool(handle, workers=1, backlog=2, overflow=workers.COALESCE)
+    for i in range(4):
+        await pool.put('x', ('x', i), coalesce='topic')
+    assert pool.coalesced == 3 and pool.depth == 1
+    handled.clear()
+    tasks = await pool.start()
+    await asyncio.sleep(0.01)
+    assert handled == [('x', 3)]
+    await utils.utils.cancel_tasks(*tasks)
+
+
+@pytest.mark.asyncio
+async def test_raw_payload():
+    from smarthome import things
+    from smarthome.events import bus, CHANGED
+    from smarthome.utils.converters import str_to_bool, from_bytes
+
+    assert str_to_bool('True') and str_to_bool(' on') and not str_to_bool('off')
+    assert from_bytes(str_to_bool, b'TRUE') and from_bytes(float, b'1.5') == 1.5
+    assert from_bytes(lambda x: x * 2, b'ab') == 'abab'
+
+    temp = things.Temperature().value
+    changes = []
+    bus.subscribe(temp, CHANGED, lambda *args: changes.append(temp.value))
+    assert await temp.change(b'21.5')
+    assert not await temp.change(bytearray(b'21.5'))
+    assert temp.raw == b'21.5'
+    # value set otherwise drops raw payload, so the same payload is converted again
+    await temp.change(20)
+    assert temp.raw is None
+    assert await temp.change(b'21.5')
+    assert changes == [21.5, 20, 21.5]
+
+
+@pytest.mark.asyncio
+async def test_history():
+    from datetime import timedelta
+    from smarthome import things
+    from smarthome.history import Recorder, MAX, MIN, COUNT
+
+    now = 3600.0 * 1000
+    recorder = Recorder(raw_size=16, clock=lambda: now)
+    temp = things.Temperature().value
+    recorder.attach(temp)
+    # two hours of samples every 30 seconds
+    for i in range(240):
+        now += 30
+        await temp.change(float(i % 120))
+
+    assert len(recorder.history(temp).raw) == 16
+    assert [x for _, x in recorder.samples(temp, 60)] == [117.0, 118.0, 119.0]
+    # 117 held for 15 seconds of the window, 118 for 30 seconds
+    assert recorder.mean(temp, 45) == (117 * 15 + 118 * 30) / 45
+    # the last 10 minutes are answered from minute rollup with bucket precision: 11 buckets, 21 samples
+    assert recorder.aggregate(temp, timedelta(minutes=10), COUNT) == 21
+    assert recorder.mean(temp, timedelta(minutes=10)) == 108.5
+    assert recorder.max(temp, timedelta(hours=1)) == 119.0
+    # answered from hour rollup
+    assert recorder.aggregate(temp, timedelta(days=3), MIN) == 0.0
+    # initial value and 239 changes, the first sample did not change the value
+    assert recorder.aggregate(temp, timedelta(days=3), COUNT) == 240
+    recorder.detach(temp)
+    await temp.change(100.0)
+    assert temp not in recorder._history
+
+    # a burst of changes does not outweigh the value, that held for the rest of the window
+    recorder.attach(temp)
+    now += 540
+    for i in range(1, 11):
+        await temp.change(float(i % 2))
+        now += 6
+    assert recorder.aggregate(temp, timedelta(minutes=10), COUNT) == 11
+    assert recorder.mean(temp, timedelta(minutes=10)) == (100 * 540 + 30) / 600
@@ -0,0 +1,47 @@
+import types
+import typing
+
+from pytest import fixture
+
+from smarthome.bindings.binding import Binding
+
+
+class DummyBinding(Binding):
+    """
+    Binding, that starts at once and keeps pushed states
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.pushed: typing.List = []
+
+    async def start_binding(self):
+        return True
+
+    async def stop_binding(self):
+        pass
+
+    async def push(self, state, **data):
+        self.pushed.append(state)
+
+
+@fixture
+def make_conf():
+    """
+    Factory of config modules without root, things are added to the module by the test:
+
+    ```
+    conf = make_conf()
+    conf.lamp = things.Switch().bind_to(conf.binding)
+    app = await App.from_module('test', conf)
+    ```
+    :return: function, that makes module with "binding" (DummyBinding if binding is not passed)
+    """
+
+    def make(binding: Binding = None, name: str = 'conf') -> types.ModuleType:
+        conf = types.ModuleType(name)
+        conf.__skiproot__ = True
+        conf.binding = binding if binding is not None else DummyBinding()
+        return conf
+
+    return make